@@ -7,8 +7,9 @@
 from flask import Flask, render_template, request, abort, send_from_directory, Response
 from dotenv import dotenv_values
 from urllib.parse import unquote
-from models import db, Article
-from cli import load_db, gen_sitemaps, gen_static, gen2_static
+from models import db, Article, Slug
+from cli import load_db, migrate_db, warm_cache, gen_sitemaps, gen_static, gen2_static
+from caching import render_cache, render_article, TitlePages
 from perturbations import perturbations
 
 app = Flask(__name__)
@@ -16,9 +17,13 @@ for key, val in dotenv_values().items():
     app.config[key] = val
 db.init_app(app)
 app.cli.add_command(load_db)
+app.cli.add_command(migrate_db)
+app.cli.add_command(warm_cache)
 app.cli.add_command(gen_sitemaps)
 app.cli.add_command(gen_static)
 app.cli.add_command(gen2_static)
+pages = render_cache(app.config)
+title_pages = TitlePages()
 
 @app.route("/")
 def subdomain_list():
@@ -27,21 +32,23 @@ def subdomain_list():
 @app.route("/", subdomain="<perturbation>")
 @app.route("/<int:page>", subdomain="<perturbation>")
 def article_list(perturbation, page=1):
-    # Query only titles for efficiency
-    articles = db.session.query(Article.title).paginate(page,25)
-    if not articles.items:
+    articles = title_pages.get(perturbation, page)
+    if not articles:
         abort(404)
-    for i, article in enumerate(articles.items):
-        articles.items[i] = Article(0, article['title'], '').perturb(perturbation)
     return render_template('article_list.html', articles=articles)
 
 @app.route("/article/<title>", subdomain="<perturbation>")
 def article(title, perturbation):
-    article = Article.query.filter_by(title=Article.unperturb(unquote(title), perturbation)).first()
-    if not article:
+    # Only the id is read, from the slug table, unless the page must be rendered
+    slug = db.session.get(Slug, (perturbation, unquote(title)))
+    if not slug:
         abort(404)
-    article.perturb(perturbation)
-    return render_template('article.html', article=article)
+    key = (perturbation, slug.article_id)
+    page = pages.get(key) or pages.put(key, render_article(db.session.get(Article, slug.article_id), perturbation))
+    response = Response(page.body, mimetype='text/html')
+    response.set_etag(page.etag)
+    response.last_modified = page.modified
+    return response.make_conditional(request)
 
 @app.route('/robots.txt')
 @app.route('/robots.txt', subdomain="<perturbation>")
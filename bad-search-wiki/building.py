@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# building.py
+# December 2021
+# Renders static article pages on a pool of worker processes.
+#
+import gzip
+import hashlib
+import json
+from os import makedirs, remove, replace
+from os.path import join, dirname, exists
+from jinja2 import Environment, FileSystemLoader, meta, select_autoescape
+from models import Article
+from pipeline import parallel_map
+try:
+    import brotli
+except ImportError:  # Pages are only precompressed with gzip
+    brotli = None
+
+# Same loader and escaping as the Flask app, usable in worker processes without an app context
+templates = Environment(loader=FileSystemLoader(join(dirname(__file__), 'templates')), autoescape=select_autoescape(['html', 'xml']))
+
+def template_hash(name: str) -> str:
+    """ Hash of the source of a template and every template it extends or includes. """
+    digest, pending, seen = hashlib.sha256(), [name], set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source = templates.loader.get_source(templates, name)[0]
+        digest.update(source.encode('utf-8'))
+        pending.extend(referenced for referenced in meta.find_referenced_templates(templates.parse(source)) if referenced)
+    return digest.hexdigest()
+
+def compress(body: bytes) -> dict:
+    """ A page with its precompressed siblings, by filename suffix. """
+    outputs = {'': body, '.gz': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        outputs['.br'] = brotli.compress(body)
+    return outputs
+
+def write_page(root: str, path: str, outputs: dict) -> None:
+    for suffix, body in outputs.items():
+        filename = join(root, path + suffix)
+        makedirs(dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(body)
+
+def render_page(job: tuple) -> tuple:
+    """ Perturb and render one article page. Runs in a pipeline worker process. """
+    path, template, id, title, text, perturbation = job
+    article = Article(id, title, text).perturb(perturbation)
+    return path, compress(templates.get_template(template).render(article=article).encode('utf-8'))
+
+def build_pages(root: str, name: str, pages: list, template: str = 'article.html', workers: int = None) -> int:
+    """
+    Render (path, article, perturbation) pages under root, skipping any page
+    whose article, perturbation and template are unchanged since the last
+    build of the same name, as recorded by a manifest of content hashes.
+    Pages left over from the previous build are removed. Returns the number
+    of pages rendered.
+    """
+    manifest = join(root, '.build', f'{name}.json')
+    previous = {}
+    if exists(manifest):
+        with open(manifest, 'r') as f:
+            previous = json.load(f)
+    templated = template_hash(template)
+    current, jobs = {}, []
+    for path, article, perturbation in pages:
+        key = hashlib.sha256(json.dumps([templated, perturbation, article.id, article.title, article.text]).encode('utf-8')).hexdigest()
+        current[path] = key
+        if previous.get(path) != key or not exists(join(root, path)):
+            jobs.append((path, template, article.id, article.title, article.text, perturbation))
+    for path in previous.keys() - current.keys():
+        for suffix in ('', '.gz', '.br'):
+            if exists(join(root, path + suffix)):
+                remove(join(root, path + suffix))
+    for path, outputs in parallel_map(render_page, jobs, workers, ordered=False):
+        write_page(root, path, outputs)
+    makedirs(dirname(manifest), exist_ok=True)
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump(current, f)
+    replace(manifest + '.tmp', manifest)
+    return len(jobs)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# caching.py
+# December 2021
+# Caches rendered article pages in memory and on disk.
+#
+import hashlib
+import re
+from collections import OrderedDict, namedtuple
+from os import makedirs, replace, getpid, listdir, remove, rmdir
+from os.path import join, dirname, exists, getmtime, isdir
+from threading import Lock
+from time import time
+from flask import render_template
+from models import db, Article
+from perturbations import perturbations, gen2_perturbations, text_perturber
+
+# Files written by the render cache: pages and the temporary files they are written through
+CACHED_FILE = re.compile(r'\d+\.html(\.\d+\.tmp)?')
+
+# A rendered page with the validators sent alongside it
+Page = namedtuple('Page', ['body', 'etag', 'modified'])
+# A page of the article list, with the attributes its template uses
+TitlePage = namedtuple('TitlePage', ['items', 'page', 'has_prev', 'has_next'])
+
+def make_page(body: bytes, modified: float) -> Page:
+    return Page(body, hashlib.sha1(body).hexdigest(), modified)
+
+def render_article(article, perturbation: str) -> bytes:
+    """ Render the page of an article under a perturbation. """
+    return render_template('article.html', article=article.clone().perturb(perturbation)).encode('utf-8')
+
+class RenderCache():
+    """
+    LRU cache of rendered pages keyed by (perturbation, article id), holding
+    at most `max_bytes` of pages in memory. With a `directory`, pages are also
+    written to disk, where they outlive the process and are shared by every
+    worker, and pages missing from memory are read back from there.
+    """
+    def __init__(self, max_bytes: int = 64*1024*1024, directory: str = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.pages = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def path(self, key: tuple) -> str:
+        perturbation, id = key
+        return join(self.directory, perturbation, f'{id}.html')
+
+    def get(self, key: tuple) -> Page:
+        with self.lock:
+            if key in self.pages:
+                self.pages.move_to_end(key)
+                return self.pages[key]
+        if self.directory and exists(path := self.path(key)):
+            with open(path, 'rb') as f:
+                return self.remember(key, make_page(f.read(), getmtime(path)))
+        return None
+
+    def put(self, key: tuple, body: bytes) -> Page:
+        modified = time()
+        if self.directory:
+            path = self.path(key)
+            makedirs(dirname(path), exist_ok=True)
+            # Written to a temporary file and renamed so other workers never read a partial page
+            with open(f'{path}.{getpid()}.tmp', 'wb') as f:
+                f.write(body)
+            replace(f'{path}.{getpid()}.tmp', path)
+            modified = getmtime(path)
+        return self.remember(key, make_page(body, modified))
+
+    def remember(self, key: tuple, page: Page) -> Page:
+        with self.lock:
+            if key in self.pages:
+                self.size -= len(self.pages.pop(key).body)
+            if len(page.body) <= self.max_bytes:
+                self.pages[key] = page
+                self.size += len(page.body)
+            while self.size > self.max_bytes:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted.body)
+        return page
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
+        if self.directory:
+            # Only the pages written by the cache are removed, whatever else shares the directory
+            for perturbation in perturbations + gen2_perturbations:
+                path = join(self.directory, perturbation)
+                if not isdir(path):
+                    continue
+                for name in listdir(path):
+                    if CACHED_FILE.fullmatch(name):
+                        remove(join(path, name))
+                if not listdir(path):
+                    rmdir(path)
+
+def render_cache(config) -> RenderCache:
+    """ Build the render cache configured by RENDER_CACHE_BYTES and RENDER_CACHE_DIR. """
+    return RenderCache(int(config.get('RENDER_CACHE_BYTES', 64*1024*1024)), config.get('RENDER_CACHE_DIR') or None)
+
+class TitlePages():
+    """
+    Pages of perturbed article titles in id order. Each page is read by
+    keyset from the id of its first article, found from page boundaries built
+    in one pass over the ids on first use, so deep pages cost no more than the
+    first and no OFFSET or COUNT queries are made. The most recently used
+    `max_pages` pages of titles are kept, already perturbed. Boundaries are
+    read once per process, so the server must be restarted after load-db.
+    """
+    def __init__(self, per_page: int = 25, max_pages: int = 4096):
+        self.per_page = per_page
+        self.max_pages = max_pages
+        self.starts = None
+        self.pages = OrderedDict()
+        self.lock = Lock()
+
+    def boundaries(self) -> list:
+        with self.lock:
+            if self.starts is None:
+                ids = [id for id, in db.session.query(Article.id).order_by(Article.id)]
+                self.starts = ids[::self.per_page]
+        return self.starts
+
+    def get(self, perturbation: str, page: int) -> TitlePage:
+        """ A page of titles under a perturbation, numbered from 1, or None past the last page. """
+        starts = self.boundaries()
+        if not 1 <= page <= len(starts):
+            return None
+        key = (perturbation, page)
+        with self.lock:
+            if key in self.pages:
+                self.pages.move_to_end(key)
+                return self.pages[key]
+        p = text_perturber(perturbation)
+        titles = db.session.query(Article.title).filter(Article.id >= starts[page-1]).order_by(Article.id).limit(self.per_page)
+        items = [{'title': p(title, title)} for title, in titles]
+        result = TitlePage(items, page, page > 1, page < len(starts))
+        with self.lock:
+            self.pages[key] = result
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return result
@@ -8,25 +8,38 @@ import click
 import wikitextparser as wtp
 from typing import Iterator
 from flask.cli import with_appcontext
-from flask import render_template
+from flask import render_template, current_app
 from urllib.request import urlopen
 from shutil import copyfileobj
-from os import remove, makedirs
+from os import remove, makedirs, replace
 from bz2 import decompress
 from re import sub
 from html2text import html2text as htt
 from tqdm import tqdm
-from models import Article
+from models import Article, Slug, SlugBuild
 from constants import SIMPLE_WIKI_URL, TMP_FILE
 from app import db
-from xml_sitemap_writer import XMLSitemap
-from perturbations import perturb, perturbations
+from sitemaps import SitemapWriter
+from perturbations import perturbations, gen2_perturbations, text_perturber
+from pipeline import parallel_map
+from caching import render_cache, render_article
+from building import build_pages, compress, write_page
 from urllib.parse import quote
 from dotenv import dotenv_values
 from os import makedirs
 from shutil import rmtree, copytree
+from sqlalchemy import event
 from sqlalchemy.sql import func
 from datetime import datetime
+from itertools import islice
+from contextlib import ExitStack
+from time import perf_counter
+from os.path import exists, dirname
+import json
+
+# SQLite settings for a one-shot build: nothing is synced to disk and the
+# rollback journal is kept in memory, so an interrupted load must be rerun
+BULK_PRAGMAS = ['synchronous = OFF', 'journal_mode = MEMORY', 'temp_store = MEMORY', 'cache_size = -262144']
 
 def dewiki(text):
     text = wtp.parse(text).plain_text()  # wiki to plaintext 
@@ -54,31 +67,109 @@ def analyze_chunk(text):
         print(oops)
         return None
 
-def save_article(article):
-    doc = analyze_chunk(article)
-    if doc:
-        entry = Article(doc['id'], doc['title'], doc['text'])
-        db.session.add(entry)
+def article_rows(docs) -> Iterator[dict]:
+    """ Rows of the article table for each cleaned article. """
+    for doc in docs:
+        if doc:
+            yield {'id': int(doc['id']), 'title': doc['title'], 'text': doc['text']}
+
+def slug_rows(articles) -> Iterator[dict]:
+    """ Rows of the slug table for every perturbation of each (id, title). """
+    perturbers = [(perturbation, text_perturber(perturbation)) for perturbation in perturbations + gen2_perturbations]
+    for id, title in articles:
+        for perturbation, p in perturbers:
+            yield {'perturbation': perturbation, 'slug': p(title, title), 'article_id': id}
+
+def save_rows(insert, rows, batch_size=10000) -> int:
+    """ Run an insert statement over rows with one executemany per
+        transaction of batch_size rows. Returns the number of rows saved. """
+    # One iterator shared by every batch, so no batch restarts (or abandons) the input
+    rows, saved = iter(rows), 0
+    while batch := list(islice(rows, batch_size)):
+        db.session.execute(insert, batch)
         db.session.commit()
+        saved += len(batch)
+    return saved
 
-def process_file_text(filename):
-    article = ''
-    # Create table
-    db.create_all()
-    # Delete existing exntries, if any
-    Article.query.delete()
+def save_slugs(batch_size=10000) -> int:
+    """ Rebuild the slug table from the article titles. """
+    SlugBuild.query.delete()
+    Slug.query.delete()
+    articles = db.session.query(Article.id, Article.title).order_by(Article.id).all()
+    expected = len(articles) * len(perturbations + gen2_perturbations)
+    # Where perturbed titles collide, the first article keeps the slug
+    insert = Slug.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite')
+    saved = save_rows(insert, tqdm(slug_rows(articles), total=expected, desc='Saving Slugs'), batch_size)
+    assert saved == expected, f'Saved {saved} of {expected} slugs'
+    stored = Slug.query.count()
+    if stored < expected:
+        print(f'{expected - stored} perturbed titles collided with another article and were not saved.')
+    # Recorded only once the table is complete, so an interrupted build is redone
+    db.session.add(SlugBuild(id=1, articles=len(articles), slugs=stored))
+    db.session.commit()
+    return saved
+
+def slugs_complete() -> bool:
+    """ Whether the slug table is as last fully built, for the current articles. """
+    build = db.session.get(SlugBuild, 1)
+    return build is not None and build.articles == Article.query.count() and build.slugs == Slug.query.count()
+
+def bulk_pragmas(connection, record):
+    cursor = connection.cursor()
+    for pragma in BULK_PRAGMAS:
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
+def read_pages(filename: str) -> Iterator[str]:
     with open(filename, 'r', encoding='utf-8') as infile:
-        for line in tqdm(infile, desc="Processing Export"):
+        article = []
+        for line in infile:
             if '<page>' in line:
-                article = ''
+                article = []
             elif '</page>' in line:  # end of article
-                save_article(article)
+                yield ''.join(article)
             else:
-                article += line                
+                article.append(line)
+
+def process_file_text(filename, workers=None, ordered=True, batch_size=10000, fast=False):
+    # Create table
+    db.create_all()
+    # Delete existing exntries, if any
+    Article.query.delete()
+    db.session.commit()
+    # Indexes are built once after the load rather than updated on every insert
+    indexes = list(Article.__table__.indexes)
+    for index in indexes:
+        index.drop(db.engine, checkfirst=True)
+    fast = fast and db.engine.dialect.name == 'sqlite'
+    if fast:
+        # Pooled connections are discarded so every new one gets the pragmas
+        event.listen(db.engine, 'connect', bulk_pragmas)
+        db.engine.dispose()
+    try:
+        start = perf_counter()
+        pages = tqdm(read_pages(filename), desc="Processing Export")
+        saved = save_rows(Article.__table__.insert(), article_rows(parallel_map(analyze_chunk, pages, workers, ordered)), batch_size)
+        elapsed = perf_counter() - start
+        print(f'Saved {saved} articles in {elapsed:.0f}s ({saved/elapsed:.0f} rows/sec).')
+        save_slugs(batch_size)
+    finally:
+        if fast:
+            db.session.close()
+            event.remove(db.engine, 'connect', bulk_pragmas)
+            db.engine.dispose()
+        # Rebuilt even after a failed load, so the table is never left without them
+        print("Building indexes...")
+        for index in indexes:
+            index.create(db.engine, checkfirst=True)
 
 @click.command('load-db')
+@click.option('--workers', type=int, default=None, help='Number of processes cleaning wikitext (defaults to the CPU count).')
+@click.option('--unordered', is_flag=True, help='Save articles as soon as they are cleaned rather than in dump order.')
+@click.option('--batch-size', type=int, default=10000, help='Number of articles inserted per transaction.')
+@click.option('--fast', is_flag=True, help='Build SQLite databases without syncing to disk (an interrupted load must be rerun).')
 @with_appcontext
-def load_db():
+def load_db(workers, unordered, batch_size, fast):
     # Define temp files
     bz2_temp = TMP_FILE+'.bz2'
     xml_temp = TMP_FILE+'.xml'
@@ -99,83 +190,122 @@ def load_db():
 
     # Process WikiXML into SQL
     print("Loading data into SQL DB...")
-    process_file_text(xml_temp)
+    process_file_text(xml_temp, workers, not unordered, batch_size, fast)
 
     # Delete decompressed temp file
     print("Removing extracted archive...")
     remove(xml_temp)
 
+    # Pages rendered from the previous database are stale
+    render_cache(current_app.config).clear()
+
     # Confirm success
     print(f'Successfully built Simple Wikipedia database.')
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db():
+    """ Add any tables and indexes missing from an existing database. """
+    db.create_all()
+    for index in Article.__table__.indexes:
+        print(f'Creating index {index.name}...')
+        index.create(db.engine, checkfirst=True)
+    if not slugs_complete():
+        print('Saving missing slugs...')
+        save_slugs()
+    print('Database is up to date.')
+
+@click.command('warm-cache')
+@click.argument('titles', type=click.File('r', encoding='utf-8'))
+@click.option('--perturbation', 'chosen', multiple=True, type=click.Choice(perturbations), help='Perturbation to render (repeatable, defaults to all).')
+@with_appcontext
+def warm_cache(titles, chosen):
+    """ Pre-render the articles listed one title per line in TITLES into the on-disk render cache. """
+    cache = render_cache(current_app.config)
+    if cache.directory is None:
+        raise click.UsageError('Set RENDER_CACHE_DIR in .env to warm the render cache.')
+    titles = list(dict.fromkeys(line.strip() for line in titles if line.strip()))
+    articles = []
+    for start in range(0, len(titles), 500):  # Stay within SQLite's limit on query parameters
+        articles.extend(Article.query.filter(Article.title.in_(titles[start:start+500])))
+    for article in tqdm(articles, desc='Rendering Articles'):
+        for perturbation in chosen or perturbations:
+            cache.put((perturbation, article.id), render_article(article, perturbation))
+    print(f'Rendered {len(articles)} of {len(titles)} articles into {cache.directory}.')
+
 @click.command('gen-sitemaps')
 @with_appcontext
 def gen_sitemaps():
     print("Building sitemaps...")
     sitemaps = 'static/sitemaps'
     server = dotenv_values()["SERVER_NAME"]
-    rmtree(sitemaps, ignore_errors=True)
-    makedirs(sitemaps)
-    with open(f'{sitemaps}/sitemap.xml', 'w') as f:
+    # Built alongside the served sitemaps and swapped in once complete
+    building = sitemaps + '.tmp'
+    rmtree(building, ignore_errors=True)
+    makedirs(building)
+    with open(f'{building}/sitemap.xml', 'w') as f:
         f.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
         for perturbation in perturbations:
             f.write(f'        <url><loc>https://{perturbation}.{server}</loc></url>\n')
         f.write('</urlset>\n')
-    for perturbation in perturbations:
-        def get_urls() -> Iterator[str]:
-            for article in db.session.query(Article.title).yield_per(1000):
-                yield f'/article/{quote(perturb(article["title"], perturbation))}'
-        path = f'{sitemaps}/{perturbation}'
-        makedirs(path, exist_ok=True)
-        with XMLSitemap(path=path, root_url=f'https://{perturbation}.{server}') as sitemap:
-            sitemap.add_urls(get_urls())
-        with open(f'{path}/sitemap.xml', 'r') as f:
-            sitemap = f.read()
-        with open(f'{path}/sitemap.xml', 'w') as f:
-            f.write(sitemap.replace(f'https://{perturbation}.{server}', f'https://{perturbation}.{server}/sitemaps'))   
+    # Titles are read once, with every perturbation's sitemaps written as they stream past
+    with ExitStack() as stack:
+        writers = {}
+        for perturbation in perturbations:
+            makedirs(f'{building}/{perturbation}')
+            writers[perturbation] = (text_perturber(perturbation), stack.enter_context(SitemapWriter(f'{building}/{perturbation}', f'https://{perturbation}.{server}/sitemaps')))
+        for title, in tqdm(db.session.query(Article.title).yield_per(1000), desc='Writing Sitemaps'):
+            for perturbation, (p, writer) in writers.items():
+                writer.add(f'https://{perturbation}.{server}/article/{quote(p(title, title))}')
+    rmtree(sitemaps, ignore_errors=True)
+    replace(building, sitemaps)
     print("Sitemap building complete.")
 
 
+def static_articles(pages: int, selection: str, reselect: bool = False) -> list:
+    """ A random choice of articles, recorded in selection so that later
+        builds keep every page on the same article while it still exists. """
+    if exists(selection) and not reselect:
+        with open(selection, 'r') as f:
+            ids = json.load(f)
+        found = {article.id: article for article in Article.query.filter(Article.id.in_(ids))}
+        if len(ids) == pages and len(found) == len(ids):
+            return [found[id] for id in ids]
+    articles = list(Article.query.filter(~Article.title.contains('/')).order_by(func.random()).limit(pages))
+    makedirs(dirname(selection), exist_ok=True)
+    with open(selection + '.tmp', 'w') as f:
+        json.dump([article.id for article in articles], f)
+    replace(selection + '.tmp', selection)
+    return articles
+
 @click.command("gen-static")
 @click.argument("pages", type=int, default=100)
+@click.option('--workers', type=int, default=None, help='Number of processes rendering pages (defaults to the CPU count).')
+@click.option('--reselect', is_flag=True, help='Choose a new random set of articles rather than those of the last build.')
 @with_appcontext
-def gen_static(pages):
+def gen_static(pages, workers, reselect):
     """Generate static pages for each perturbation."""
-    articles = list(Article.query.filter(~Article.title.contains('/')).order_by(func.random()).limit(pages))
-    rmtree('public_html/')
-    for perturbation in perturbations:
-        makedirs(f'public_html/{perturbation}', exist_ok=True)
-        for index, article in enumerate(articles):
-            perturbed = article.clone().perturb(perturbation)
-            with open(f'public_html/{perturbation}/{index}.html', 'w') as f:
-                f.write(render_template('article.html', article=perturbed))
-    with open('public_html/index.html', 'w') as f:
-        f.write(render_template('flat_article_list.html', articles=articles, perturbations=perturbations,))
-    with open('public_html/sitemap.xml', 'w') as f:
-        f.write(render_template('sitemap.xml', articles=articles, perturbations=perturbations, server=dotenv_values()["SERVER_NAME"], now=datetime.now()))
-    with open('public_html/robots.txt', 'w') as f:
-        f.write(render_template('robots.txt', server=dotenv_values()["SERVER_NAME"]))
-    copytree('static', 'public_html/static')
-    print("Static pages generated.")
+    articles = static_articles(pages, 'public_html/.build/gen-static-articles.json', reselect)
+    jobs = [(f'{perturbation}/{index}.html', article, perturbation) for perturbation in perturbations for index, article in enumerate(articles)]
+    rendered = build_pages('public_html', 'gen-static', jobs, workers=workers)
+    write_page('public_html', 'index.html', compress(render_template('flat_article_list.html', articles=articles, perturbations=perturbations,).encode('utf-8')))
+    write_page('public_html', 'sitemap.xml', compress(render_template('sitemap.xml', articles=articles, perturbations=perturbations, server=dotenv_values()["SERVER_NAME"], now=datetime.now()).encode('utf-8')))
+    write_page('public_html', 'robots.txt', compress(render_template('robots.txt', server=dotenv_values()["SERVER_NAME"]).encode('utf-8')))
+    copytree('static', 'public_html/static', dirs_exist_ok=True)
+    print(f"Static pages generated ({rendered} of {len(jobs)} rendered, the rest unchanged).")
 
 @click.command("gen2-static")
 @click.argument("pages", type=int, default=5)
+@click.option('--workers', type=int, default=None, help='Number of processes rendering pages (defaults to the CPU count).')
 @with_appcontext
-def gen2_static(pages):
+def gen2_static(pages, workers):
     """ Generates static pages for the second generation experiments."""
-    perturbations = ['zwsp2', 'homo2']
+    perturbations = gen2_perturbations
     articles = ['Hans Zender', 'Great Bentley', 'Jerrier A. Haddad', 'IPhone 5C', 'Shelley, Idaho', 'A Day in the Life', 'George Polk Awards', 'Helen Herron Taft', 'Gilles Latulippe', 'Kitty Hawk, North Carolina', 'Charlotte Rae', 'Vaudes', 'Battleship Potemkin', 'Oak Park, Illinois', 'Plouégat-Guérand', 'Leah Clark', 'Free market', 'Cullowhee, North Carolina', 'Herat', 'Seaca de Câmp', 'Oro y plata', 'Jerry Mathers', 'Greg Papa', 'Duško Popov', 'Sacheen Littlefeather', 'Daydreaming (song)', 'Sverigetopplistan', 'The Godfather Part II', 'Emerson, Lake and Powell', 'Paranthropus aethiopicus', 'Didí Torrico', 'Swan', 'Christine Keeler', 'Samir Farid', 'Canonical form', 'Christina Hendricks', 'Little India MRT station', 'Tracie Spencer', 'Luc-Adolphe Tiao', 'Christopher A. Wray', 'Nezapir', 'Yoram Globus', 'Joseph D. Pistone', 'Datsakorn Thonglao', 'COVID-19 pandemic in Missouri', 'Alan Shearer', 'Shanghai World Financial Center', 'Adam Deadmarsh', '65th British Academy Film Awards', 'Members Church of God International', 'Winter solstice', 'The Family Jewels (movie)', 'Gurtnellen', 'Soriano Department', '119 Tauri', 'Adelaide Kane', 'Frances Farenthold', 'Praça Diogo de Vasconcelos', 'Centennial Olympic Park bombing', 'La Pommeraie-sur-Sèvre', 'Mycoplasma genitalium', 'Dozwil', 'Leeds Cathedral', 'Cuts Both Ways', 'Chisago Lakes', 'Aberaeron', 'Enhanced Fujita scale', 'Cappy, Somme', 'King George V DLR station', 'Claw', 'Cremona', 'Insurance (constituency)', 'Waqar Ahmad Shah', 'Ed Westcott', 'Cerebellum', '1st century BC', 'Mateur', 'Gary Staples', 'List of A2 roads', 'Naked eye', 'Odra', 'Ross Ardern', 'Twist (dance)', '2019 NASCAR Xfinity Series', 'In-N-Out Burger', 'Selous&#39; zebra', 'Hillary Clinton', 'Jussy, Aisne', 'Provinces of Oman', 'Source code', 'Vätterstads IK', 'The Illustrated World of Mortal Engines', 'First Sino-Japanese War', 'Sainte-Suzanne-et-Chammes', 'Joël Bouchard', 'Dado Cavalcanti', 'Lucky Pulpit', 'Monte Plata Province', 'Glovelier', 'Cape Breton Island']
     articles = articles[:pages]
-    for perturbation in perturbations:
-        rmtree(f'public_html/{perturbation}', ignore_errors=True)
-        makedirs(f'public_html/{perturbation}')
-    for idx, title in enumerate(articles):
-        article = Article.query.filter(Article.title == title).first()
-        for perturbation in perturbations:
-            perturbed = article.clone().perturb(perturbation)
-            with open(f'public_html/{perturbation}/{idx}.html', 'w') as f:
-                f.write(render_template('article.html', article=perturbed))
-    with open('public_html/gen2_sitemap.xml', 'w') as f:
-        f.write(render_template('sitemap.xml', articles=articles, perturbations=perturbations, server=dotenv_values()["SERVER_NAME"], now=datetime.now()))    
-    print("Static pages generated.")
+    found = {article.title: article for article in Article.query.filter(Article.title.in_(articles))}
+    jobs = [(f'{perturbation}/{idx}.html', found[title], perturbation) for idx, title in enumerate(articles) if title in found for perturbation in perturbations]
+    rendered = build_pages('public_html', 'gen2-static', jobs, workers=workers)
+    write_page('public_html', 'gen2_sitemap.xml', compress(render_template('sitemap.xml', articles=articles, perturbations=perturbations, server=dotenv_values()["SERVER_NAME"], now=datetime.now()).encode('utf-8')))
+    print(f"Static pages generated ({rendered} of {len(jobs)} rendered, the rest unchanged).")
         
\ No newline at end of file
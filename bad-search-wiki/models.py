@@ -5,7 +5,7 @@
 # Contains DB models.
 #
 from flask_sqlalchemy import SQLAlchemy
-from perturbations import perturb, unperturb
+from perturbations import text_perturber, unperturber
 
 # Initialize db variable to avoid namespace errors
 # ('db' must be imported by application later)
@@ -13,7 +13,8 @@ db = SQLAlchemy()
 
 class Article(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.Text)
+    # Indexed as every article request looks its title up
+    title = db.Column(db.Text, index=True)
     text = db.Column(db.Text)
 
     def __init__(self, id, title, text):
@@ -25,10 +26,9 @@ class Article(db.Model):
         return '<Article %r>' % self.title
 
     def perturb(self, perturbation: str):
-        def perturb_words(input: str) -> str:
-            return ' '.join(map(lambda w: perturb(w, perturbation, title=self.title), input.split(' ')))
-        self.text = perturb_words(self.text)
-        self.title = perturb_words(self.title)
+        p = text_perturber(perturbation)
+        self.text = p(self.text, self.title)
+        self.title = p(self.title, self.title)
         return self
 
     def clone(self) -> 'Article':
@@ -36,4 +36,21 @@ class Article(db.Model):
     
     @classmethod
     def unperturb(cls, input: str, perturbation: str) -> str:
-        return ' '.join(map(lambda w: unperturb(w, perturbation), input.split(' ')))
\ No newline at end of file
+        u = unperturber(perturbation)
+        return ' '.join(map(u, input.split(' ')))
+
+class Slug(db.Model):
+    """ An article's title under a perturbation, as requested in its URL,
+        so that requests are routed without reversing the perturbation. """
+    __table_args__ = {'sqlite_with_rowid': False}
+    perturbation = db.Column(db.Text, primary_key=True)
+    slug = db.Column(db.Text, primary_key=True)
+    article_id = db.Column(db.Integer, nullable=False)
+
+class SlugBuild(db.Model):
+    """ Counts recorded when the slug table was last fully built. Perturbed
+        titles that collide are not stored, so the slug count alone cannot
+        tell a complete table from a partial one. """
+    id = db.Column(db.Integer, primary_key=True)
+    articles = db.Column(db.Integer, nullable=False)
+    slugs = db.Column(db.Integer, nullable=False)
@@ -6,56 +6,192 @@
 #
 from flask import abort
 from homoglyphs import Homoglyphs
-from random import sample, randrange
+import hashlib
+import json
+import sqlite3
+import os
+from os import environ
+from random import Random
+from threading import Lock
+from functools import lru_cache
 
 perturbations = ['base', 'zwsp', 'zwnj', 'zwj', 'rlo', 'bksp', 'del', 'homo']
+# Served only for the second generation experiments
+gen2_perturbations = ['zwsp2', 'homo2']
 homoglyphs = Homoglyphs()
-zwsp_map = {}
+# Optional on-disk memo of zwsp2 perturbations, opened below
+zwsp2_store = None
 
 def perturb(input: str, perturbation: str, title: str = '') -> str:
-    match perturbation:
-        case 'base' : return input
-        case 'zwsp' : return '\u200B'.join(list(input))
-        case 'zwnj' : return '\u200C'.join(list(input))
-        case 'zwj'  : return '\u200D'.join(list(input))
-        case 'rlo'  : return '\u2066\u202E' + input[::-1] + '\u202C\u2069'
-        case 'bksp' : return input[:int(len(input)/2)] + 'X\u0008' + input[int(len(input)/2):]
-        case 'del'  : return input[:int(len(input)/2)] + 'X\u007F' + input[int(len(input)/2):]
-        case 'homo' : return ''.join(map(lambda c: (n := homoglyphs.get_combinations(c))[p if (p := n.index(c)+1) < len(n) else 0], list(input)))
-        case 'zwsp2': return zwsp2(input, title)
-        case 'homo2': return homo2(input)
-        case _ : abort(404)
+    return perturber(perturbation)(input, title)
+
+def perturb_text(input: str, perturbation: str, title: str = '') -> str:
+    """ Perturb every space-separated word of a document. Gives the same result as
+        joining perturb() over input.split(' '), but where the technique allows it
+        the whole text is transformed in a few passes rather than word by word. """
+    return text_perturber(perturbation)(input, title)
 
 def unperturb(input: str, perturbation: str) -> str:
-    match perturbation:
-        case 'base' : return input
-        case 'zwsp' : return input.replace('\u200B', '')
-        case 'zwnj' : return input.replace('\u200C', '')
-        case 'zwj'  : return input.replace('\u200D', '')
-        case 'rlo'  : return input[2:-2][::-1]
-        case 'bksp' : return input[:int((len(input)-2)/2)] + input[int((len(input)-2)/2)+2:]
-        case 'del'  : return input[:int((len(input)-2)/2)] + input[int((len(input)-2)/2)+2:]
-        case 'homo' : return ''.join(map(lambda c: (n := homoglyphs.get_combinations(c))[max(n.index(c)-1, 0)], list(input)))
-        case _ : abort(404)
+    return unperturber(perturbation)(input)
+
+def perturber(perturbation: str):
+    """ Look up the callable implementing a perturbation technique. """
+    if perturbation not in perturbers:
+        abort(404)
+    return perturbers[perturbation]
+
+def text_perturber(perturbation: str):
+    """ Look up the callable perturbing every word of a whole text at once. """
+    if perturbation not in text_perturbers:
+        abort(404)
+    return text_perturbers[perturbation]
+
+def unperturber(perturbation: str):
+    """ Look up the callable reversing a perturbation technique. """
+    if perturbation not in unperturbers:
+        abort(404)
+    return unperturbers[perturbation]
+
+def homoglyph_tables() -> tuple[dict, dict]:
+    """ Build translation tables mapping each character to the next (perturb)
+        or previous (unperturb) character in its list of homoglyphs. """
+    forward, reverse = {}, {}
+    for c in homoglyphs.alphabet:
+        n = homoglyphs.get_combinations(c)
+        p = n.index(c)
+        forward[ord(c)] = n[p+1 if p+1 < len(n) else 0]
+        reverse[ord(c)] = n[max(p-1, 0)]
+    return forward, reverse
 
 def zwsp2(input: str, title: str) -> str:
-    if title in zwsp_map:
-        perturbs = zwsp_map[title]
-    else:
-        words = title.split(' ')
-        perturbs = []
-        for word in words:
-            for _ in range(randrange(1,max(len(word)//2,2))):
-                idx = randrange(len(word)+1)
-                word = word[:idx] + '\u200B'*randrange(1,6) + word[idx:]
-            perturbs.append(word)
-        zwsp_map[title] = perturbs
+    perturbs = zwsp2_words(title)
     try:
         idx = title.split(' ').index(input)
         return perturbs[idx]
     except ValueError:
         return input
 
+@lru_cache(maxsize=65536)
+def zwsp2_words(title: str) -> tuple:
+    """ Insert runs of zero width spaces into each word of a title, at
+        positions drawn from a generator seeded with a hash of the title, so
+        every process and run agrees. Memoized in a bounded LRU and, if
+        ZWSP2_STORE names one, an SQLite store shared between processes. """
+    if zwsp2_store is not None and (perturbs := zwsp2_store.get(title)) is not None:
+        return perturbs
+    rng = Random(hashlib.sha256(title.encode('utf-8')).digest())
+    perturbs = []
+    for word in title.split(' '):
+        for _ in range(rng.randrange(1,max(len(word)//2,2))):
+            idx = rng.randrange(len(word)+1)
+            word = word[:idx] + '\u200B'*rng.randrange(1,6) + word[idx:]
+        perturbs.append(word)
+    perturbs = tuple(perturbs)
+    if zwsp2_store is not None:
+        zwsp2_store.put(title, perturbs)
+    return perturbs
+
+class Zwsp2Store():
+    """ On-disk memo of zwsp2 perturbations by title. Stored perturbations
+        are never replaced, so they outlive any change to the generator.
+        Each process opens its own connection on first use, since SQLite
+        connections must not be used across fork() by pool workers. """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.db = None
+        self.inherited = []
+        self.lock = Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.forget)
+
+    def forget(self) -> None:
+        # Kept referenced rather than closed, as closing would act on the parent's database state
+        if self.db is not None:
+            self.inherited.append(self.db)
+        self.db, self.lock = None, Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS zwsp2 (title TEXT PRIMARY KEY, words TEXT NOT NULL)')
+        return self.db
+
+    def get(self, title: str) -> tuple:
+        with self.lock:
+            row = self.connection().execute('SELECT words FROM zwsp2 WHERE title = ?', (title,)).fetchone()
+        return tuple(json.loads(row[0])) if row else None
+
+    def put(self, title: str, words: tuple) -> None:
+        with self.lock:
+            with self.connection() as db:
+                db.execute('INSERT OR IGNORE INTO zwsp2 VALUES (?, ?)', (title, json.dumps(words)))
+
+if environ.get('ZWSP2_STORE'):
+    zwsp2_store = Zwsp2Store(environ['ZWSP2_STORE'])
+
+def zwsp2_text(input: str, title: str) -> str:
+    # Each word takes the perturbation of its first occurrence in the title
+    lookup = {}
+    for word, perturbed in zip(title.split(' '), zwsp2_words(title)):
+        lookup.setdefault(word, perturbed)
+    return ' '.join([lookup.get(w, w) for w in input.split(' ')])
+
+def join_text(separator: str):
+    """ Insert separator between adjacent characters of each word of a text. """
+    return lambda input, title: separator.join(input).replace(separator+' ', ' ').replace(' '+separator, ' ')
+
+def per_word(perturbation: str):
+    """ Apply a perturbation to each space-separated word of a text. """
+    p = perturbers[perturbation]
+    return lambda input, title: ' '.join([p(w, title) for w in input.split(' ')])
+
+hg2 = {'-':'−','.':'ꓸ','0':'Ο','1':'𝟷','2':'𝟸','3':'𖼻','4':'４','5':'５','6':'Ⳓ','7':'７','8':'𐌚','9':'Ꝯ','A':'Ꭺ','B':'Β','C':'𐊢','D':'Ꭰ','E':'Ꭼ','F':'𐊇','G':'Ꮐ','H':'Η','I':'Ⅰ','J':'Ꭻ','K':'K','L':'𐐛','M':'Μ','N':'ꓠ','O':'೦','P':'Р','Q':'Ｑ','R':'𖼵','S':'Տ','T':'Ꭲ','U':'Ս','V':'ꛟ','W':'Ԝ','X':'ⵝ','Y':'Ⲩ','Z':'Ꮓ','a':'а','b':'ᖯ','c':'ϲ','d':'ⅾ','e':'е','f':'𝖿','g':'ց','h':'𝗁','i':'𝚒','j':'ј','k':'𝚔','l':'ⅼ','m':'ｍ','n':'ո','o':'𐓪','p':'р','q':'ԛ','r':'𝗋','s':'ꮪ','t':'𝗍','u':'𝗎','v':'∨','w':'ꮃ','x':'᙮','y':'𝗒','z':'ᴢ'}
+
 def homo2(input: str) -> str:
-    hg = {'-':'−','.':'ꓸ','0':'Ο','1':'𝟷','2':'𝟸','3':'𖼻','4':'４','5':'５','6':'Ⳓ','7':'７','8':'𐌚','9':'Ꝯ','A':'Ꭺ','B':'Β','C':'𐊢','D':'Ꭰ','E':'Ꭼ','F':'𐊇','G':'Ꮐ','H':'Η','I':'Ⅰ','J':'Ꭻ','K':'K','L':'𐐛','M':'Μ','N':'ꓠ','O':'೦','P':'Р','Q':'Ｑ','R':'𖼵','S':'Տ','T':'Ꭲ','U':'Ս','V':'ꛟ','W':'Ԝ','X':'ⵝ','Y':'Ⲩ','Z':'Ꮓ','a':'а','b':'ᖯ','c':'ϲ','d':'ⅾ','e':'е','f':'𝖿','g':'ց','h':'𝗁','i':'𝚒','j':'ј','k':'𝚔','l':'ⅼ','m':'ｍ','n':'ո','o':'𐓪','p':'р','q':'ԛ','r':'𝗋','s':'ꮪ','t':'𝗍','u':'𝗎','v':'∨','w':'ꮃ','x':'᙮','y':'𝗒','z':'ᴢ'}
-    return ''.join(map(lambda c: hg[c] if c in hg else c, list(input)))
+    return input.translate(hg2_table)
+
+# Translation tables and per-technique callables, built once at import
+homo_table, homo_rev_table = homoglyph_tables()
+hg2_table = str.maketrans(hg2)
+
+perturbers = {
+    'base' : lambda input, title: input,
+    'zwsp' : lambda input, title: '\u200B'.join(input),
+    'zwnj' : lambda input, title: '\u200C'.join(input),
+    'zwj'  : lambda input, title: '\u200D'.join(input),
+    'rlo'  : lambda input, title: '\u2066\u202E' + input[::-1] + '\u202C\u2069',
+    'bksp' : lambda input, title: input[:int(len(input)/2)] + 'X\u0008' + input[int(len(input)/2):],
+    'del'  : lambda input, title: input[:int(len(input)/2)] + 'X\u007F' + input[int(len(input)/2):],
+    'homo' : lambda input, title: input.translate(homo_table),
+    'zwsp2': zwsp2,
+    'homo2': lambda input, title: homo2(input),
+}
+
+# Spaces separate words, so they are left untouched when translating whole texts
+homo_text_table = {**homo_table, ord(' '): ' '}
+
+text_perturbers = {
+    'base' : lambda input, title: input,
+    'zwsp' : join_text('\u200B'),
+    'zwnj' : join_text('\u200C'),
+    'zwj'  : join_text('\u200D'),
+    'rlo'  : lambda input, title: '\u2066\u202E' + '\u202C\u2069 \u2066\u202E'.join(input[::-1].split(' ')[::-1]) + '\u202C\u2069',
+    'bksp' : per_word('bksp'),
+    'del'  : per_word('del'),
+    'homo' : lambda input, title: input.translate(homo_text_table),
+    'zwsp2': zwsp2_text,
+    'homo2': lambda input, title: homo2(input),
+}
+
+unperturbers = {
+    'base' : lambda input: input,
+    'zwsp' : lambda input: input.replace('\u200B', ''),
+    'zwnj' : lambda input: input.replace('\u200C', ''),
+    'zwj'  : lambda input: input.replace('\u200D', ''),
+    'rlo'  : lambda input: input[2:-2][::-1],
+    'bksp' : lambda input: input[:int((len(input)-2)/2)] + input[int((len(input)-2)/2)+2:],
+    'del'  : lambda input: input[:int((len(input)-2)/2)] + input[int((len(input)-2)/2)+2:],
+    'homo' : lambda input: input.translate(homo_rev_table),
+}
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# sitemaps.py
+# December 2021
+# Streams URLs into gzipped sitemaps and their sitemap index.
+#
+import gzip
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+# Limits on each sitemap set by https://www.sitemaps.org/protocol.html
+URLS_PER_FILE = 50000
+BYTES_PER_FILE = 50 * 1024 * 1024
+
+class SitemapWriter():
+    """
+    Writes URLs as they arrive into gzipped sitemaps sitemap-001.xml.gz,
+    sitemap-002.xml.gz, ... under path, starting a new one whenever a sitemap
+    reaches the size limits. Closing the writer writes sitemap.xml, an index
+    of the sitemaps as served from sitemaps_url.
+    """
+    def __init__(self, path: str, sitemaps_url: str, compresslevel: int = 6):
+        self.path = path
+        self.sitemaps_url = sitemaps_url.rstrip('/')
+        self.compresslevel = compresslevel
+        self.sitemaps = []
+        self.file = None
+
+    def add(self, url: str) -> None:
+        entry = f'<url><loc>{escape(url)}</loc></url>\n'.encode('utf-8')
+        if self.file is None or self.urls == URLS_PER_FILE or self.size + len(entry) > BYTES_PER_FILE:
+            self.start()
+        self.file.write(entry)
+        self.urls += 1
+        self.size += len(entry)
+
+    def start(self) -> None:
+        self.finish()
+        self.sitemaps.append(f'sitemap-{len(self.sitemaps)+1:03}.xml.gz')
+        self.file = gzip.open(f'{self.path}/{self.sitemaps[-1]}', 'wb', compresslevel=self.compresslevel)
+        self.file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        self.urls = 0
+        self.size = 200  # Allowance for the opening and closing tags
+
+    def finish(self) -> None:
+        if self.file is not None:
+            self.file.write(b'</urlset>\n')
+            self.file.close()
+            self.file = None
+
+    def close(self) -> None:
+        self.finish()
+        lastmod = datetime.now().strftime('%Y-%m-%d')
+        with open(f'{self.path}/sitemap.xml', 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for sitemap in self.sitemaps:
+                f.write(f'\t<sitemap><loc>{escape(self.sitemaps_url)}/{sitemap}</loc><lastmod>{lastmod}</lastmod></sitemap>\n')
+            f.write('</sitemapindex>\n')
+
+    def __enter__(self) -> 'SitemapWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#
+# benchmarking.py
+# February 2023
+#
+# Utilities for benchmarking the Bing experiment query engine against
+# a local mock of the Bing Custom Search API. Should be called from the
+# command line using bing.py.
+#
+from itertools import chain
+from time import perf_counter
+from tqdm.auto import tqdm
+from experimenting import engines, srcf_articles, bing_srcf_indexed, bing_ml_indexed, search_params
+from mocking import MockIndex, MockSearchServer, srcf_pages, ml_pages
+from perturbations import perturb
+from querying import QueryEngine
+
+def mock_server(**options) -> MockSearchServer:
+    """ Mock Bing Custom Search serving both deployments of the Bad Search Wiki. """
+    sites = {engine: tuple(name.split('-')) for name, engine in engines.items()}
+    techniques = lambda site: [technique for s, technique in sites.values() if s == site and technique != 'all']
+    ml_titles = dict.fromkeys(title for _, title in bing_ml_indexed)
+    index = MockIndex(chain(srcf_pages(srcf_articles, techniques('srcf')), ml_pages(ml_titles, techniques('ml'))))
+    return MockSearchServer(index, sites, **options)
+
+def experiment_searches() -> list:
+    """ The searches made by the hiding and surfacing experiments on both sites. """
+    return [search_params(engines[technique], srcf_articles[article]) for technique, article in bing_srcf_indexed] + \
+           [search_params(engines[technique], article) for technique, article in bing_ml_indexed] + \
+           [search_params(engines['srcf-all'], perturb(srcf_articles[article], technique.replace('srcf-',''))) for technique, article in bing_srcf_indexed] + \
+           [search_params(engines['ml-all'], perturb(article, technique.replace('ml-',''))) for technique, article in bing_ml_indexed]
+
+def benchmark(per_second=3, concurrency=8, retries=5, rounds=1, **options):
+    searches = experiment_searches() * rounds
+    with mock_server(port=0, **options) as server:
+        client = QueryEngine(server.bing_url, headers={'Ocp-Apim-Subscription-Key': 'mock'}, per_second=per_second,
+                             concurrency=concurrency, retries=retries)
+        start = perf_counter()
+        responses = list(tqdm(client.search_all(searches), total=len(searches), desc='Benchmarking'))
+        elapsed = perf_counter() - start
+    found = sum(1 for response in responses if 'webPages' in response)
+    print(f'{len(responses)} queries in {elapsed:.2f}s ({len(responses)/elapsed:.2f} queries/sec), {found} with results.')
+    print(f'Server saw {server.stats["requests"]} requests: {server.stats["throttled"]} throttled, {server.stats["errors"]} failed.')
@@ -6,14 +6,14 @@
 # Utilities for searching experimental queries against perturbed
 # Simple Wikipedia. Should be called from the command line using elastic.py.
 #
-import pickle
-import requests
-import time
+import aiohttp
 from tqdm.auto import tqdm
-from datetime import datetime
-from os.path import exists
 from typing import Dict
 from perturbations import perturb
+from querying import QueryEngine, ResponseCache, QuotaExhausted
+from records import open_store
+
+BING_URL = 'https://api.bing.microsoft.com/v7.0/custom/search'
 
 # Programmable Search Engine IDs
 engines = { 'srcf-all': '71a4c1af-7bba-480a-972e-b00c10726048',
@@ -45,7 +45,9 @@ srcf_articles = ['Hans Zender', 'Great Bentley', 'Jerrier A. Haddad', 'IPhone 5C
 bing_srcf_indexed = [('srcf-base', 70), ('srcf-base', 3), ('srcf-base', 46), ('srcf-base', 83), ('srcf-del', 94), ('srcf-base', 5), ('srcf-del', 5), ('srcf-base', 60), ('srcf-bksp', 78), ('srcf-base', 50), ('srcf-base', 86), ('srcf-rlo', 44), ('srcf-rlo', 97), ('srcf-homo', 96), ('srcf-base', 39), ('srcf-bksp', 48), ('srcf-bksp', 66), ('srcf-base', 92), ('srcf-rlo', 32), ('srcf-base', 66), ('srcf-base', 36), ('srcf-base', 49), ('srcf-rlo', 10), ('srcf-bksp', 97), ('srcf-rlo', 22), ('srcf-rlo', 5), ('srcf-base', 54), ('srcf-rlo', 39), ('srcf-rlo', 27), ('srcf-del', 56), ('srcf-base', 56), ('srcf-rlo', 3), ('srcf-del', 70), ('srcf-del', 83), ('srcf-bksp', 92), ('srcf-del', 76), ('srcf-base', 78), ('srcf-base', 97), ('srcf-rlo', 92), ('srcf-rlo', 69), ('srcf-homo', 85), ('srcf-homo', 55), ('srcf-del', 2), ('srcf-rlo', 49)]
 bing_ml_indexed = [('ml-base', '2021 Peru bus crash'), ('ml-base', 'Milada Horáková'), ('ml-base', 'Harry Potter and the Half-Blood Prince'), ('ml-base', 'Stonehenge, Avebury and Associated Sites'), ('ml-base',  'British Rail locomotive and multiple unit numbering and classification'), ('ml-base', "Earth's magnetic field"), ('ml-base', "Schrödinger's cat"), ('ml-base', 'Merv Griffin'), ('ml-base', 'Pyrénées-Atlantiques'), ('ml-base', 'Abstinence'), ('ml-base', 'Juan Guaidó'), ('ml-base', 'Nestlé'), ('ml-base', 'José S Carrión'), ('ml-base', 'Non-coding DNA'), ('ml-base', 'Abutilon'), ('ml-base', 'Zdeněk Hoření'), ('ml-base', 'Disgrace of Gijón'), ('ml-base', 'Diaper'), ('ml-base', '2011 Tōhoku earthquake and tsunami'), ('ml-base', "Joule's laws"), ('ml-base', "Queen's Hall"), ('ml-base', 'List of countries and dependencies by population density'), ('ml-rlo', 'BioShock'), ('ml-base', 'Branko Kostić'), ('ml-base', 'Medusa with the Head of Perseus'), ('ml-base', 'Mazatlán'), ('ml-base', 'J.B.S. Haldane'), ('ml-rlo', 'Isekai'), ('ml-base', 'Ocean thermal energy conversion'), ('ml-base', 'Rifat Hadžiselimović'), ('ml-base', 'Apicomplexa'), ('ml-base', "Faraday's laws of electrolysis"), ('ml-base', 'Kashima-jingū'), ('ml-base', "Newton's laws of motion"), ('ml-homo', 'Brass'), ('ml-homo', 'Pier'), ('ml-base', 'Hōgen (era)'), ('ml-homo', 'Hossam Ashour'), ('ml-base', 'Stuyvesant Town–Peter Cooper Village'), ('ml-base', 'Transistor–transistor logic'), ('ml-base', 'Anais García Balmaña'), ('ml-base', 'Miloš Radulović'), ('ml-base', 'Claude Lévi-Strauss'), ('ml-base', 'Mária Pozsonec'), ('ml-base', 'Cobalt(III) fluoride'), ('ml-base', 'Ramanuja Devnathan'), ('ml-base', "Student's t-test"), ('ml-homo', 'Type species'), ('ml-base', 'Shojiro Sugimura'), ('ml-base', '2022 FIFA World Cup'), ('ml-base', 'Cobalt(III) fluoride'), ('ml-base', 'Ramanuja Devnathan'), ('ml-base', 'Shojiro Sugimura'), ('ml-base', 'Zenani Mandela-Dlamini'), ('ml-base', 'Beril Dedeoğlu'), ('ml-zwsp', 'George Metallinos'), ('ml-zwnj', 'Tenpyō-kanpō'), ('ml-zwnj', 'Han Buddhism'), ('ml-zwnj', 'East Asian calligraphy'), ('ml-zwnj', 'List of tallest buildings in China'), ('ml-zwnj', 'Donald Adamson'), ('ml-zwnj', 'Type 14 105 mm cannon'), ('ml-zwsp', 'Claudine Monteil'), ('ml-zwj', 'Chitetsu Watanabe'), ('ml-zwsp', 'Council areas of Scotland'), ('ml-zwnj', 'Arrondissement of La Rochelle'), ('ml-zwnj', 'Diekirch (canton)'), ('ml-zwsp', 'The Million Pound Drop Live'), ('ml-zwj', 'Beatová síň slávy'), ('ml-zwj', 'Tōkaidō Shinkansen'), ('ml-zwj', 'Circuit (political division)'), ('ml-zwsp', 'National Anthem of the Republic of China'), ('ml-zwsp', 'Kōō (Nanboku-chō period)'), ('ml-zwnj', 'Principality of the Pindus'), ('ml-zwsp', 'The Collection 1982-1988'), ('ml-zwnj', 'Comunità montana Walser Alta Valle del Lys'), ('ml-zwsp', 'Leader of the Opposition (Japan)'), ('ml-zwsp', 'Kitzingen (district)'), ('ml-zwnj', 'Arrondissement of Lille'), ('ml-zwj', 'Prime Minister of Singapore'), ('ml-zwj', 'Kangding Qingge'), ('ml-zwsp', 'Arrondissement of Brive-la-Gaillarde'), ('ml-zwsp', 'King Tang of Shang of China'), ('ml-zwj', 'Type 95 75 mm field gun'), ('ml-zwnj', 'Tōkaidō (region)'), ('ml-zwj', 'Empress Myeongseong'), ('ml-zwnj', 'Bremgarten (district)'), ('ml-zwj', 'Lenzburg (district)'), ('ml-zwj', '2006 Hengchun earthquakes'), ('ml-zwj', 'Nagasaki Prefecture'), ('ml-zwj', 'Carbon–hydrogen bond activation'), ('ml-zwnj', 'List of speakers of the House of Representatives (Japan)'), ('ml-zwsp', 'Densha de Go! (series)'), ('ml-zwj', 'Cabinet of Germany'), ('ml-zwsp', 'Tenshō (Momoyama period)'), ('ml-zwsp', '2013–14 Fußball-Bundesliga'), ('ml-zwj', 'Coligny calendar'), ('ml-zwj', 'Japanese Imperial year'), ('ml-zwsp', '100 Landscapes of Japan (Shōwa period)')]
 
-def experiment(site: str, key_file: str, experiment_name: str) -> None:
+def experiment(site: str, key_file: str, experiment_name: str, per_second: float = 3, per_month: int = None,
+               concurrency: int = 8, retries: int = 5, cache: str = None, cache_ttl: float = None, replay: bool = False,
+               quota_file: str = None, endpoint: str = BING_URL, **store) -> None:
     srcf = False
     ml = False
     match site:
@@ -54,191 +56,132 @@ def experiment(site: str, key_file: str, experiment_name: str) -> None:
         case 'all': srcf, ml = True, True
         case _ : raise ValueError(f'Unknown site: {site}')
     with open(key_file, 'r') as f:
-        global key
-        key = f.read()
-    match experiment_name:
-        case 'hiding': hiding_experiment(srcf, ml)
-        case 'surfacing': surfacing_experiment(srcf, ml)
-        case 'all': hiding_experiment(srcf, ml); surfacing_experiment(srcf, ml)
-        case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
-
-def hiding_experiment(srcf: bool, ml: bool) -> None:
+        key = f.read().strip()
+    responses = ResponseCache(cache, cache_ttl) if cache else None
+    client = QueryEngine(endpoint, headers={'Ocp-Apim-Subscription-Key': key}, per_second=per_second, per_month=per_month,
+                         concurrency=concurrency, retries=retries, cache=responses, cache_only=replay,
+                         quota_file=quota_file if endpoint == BING_URL else None) # Mock APIs use no quota
+    try:
+        match experiment_name:
+            case 'hiding': hiding_experiment(client, srcf, ml, **store)
+            case 'surfacing': surfacing_experiment(client, srcf, ml, **store)
+            case 'all': hiding_experiment(client, srcf, ml, **store); surfacing_experiment(client, srcf, ml, **store)
+            case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
+    except (QuotaExhausted, aiohttp.ClientResponseError) as oops:
+        # Results gathered so far were flushed as each results file closed
+        if getattr(oops, 'status', 429) != 429:
+            raise
+        print('Query quota exhausted. Rerun the experiment once it has reset to continue.')
+    if responses:
+        print(responses.stats())
+        responses.close()
+
+def hiding_experiment(client: QueryEngine, srcf: bool, ml: bool, **store) -> None:
     if srcf:
-        hiding_srcf_experiment()
+        hiding_srcf_experiment(client, **store)
     if ml:
-        hiding_ml_experiment()
-
-def hiding_srcf_experiment():
-    filename = f'bing-srcf_serps_hiding-{datetime.now().strftime("%Y-%m-%d")}.pkl'
-    if exists(filename):
-        print('Loading previous SRCF results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = pickle.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = len(bing_srcf_indexed)
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i, (technique, article) in tqdm(enumerate(bing_srcf_indexed), total=count, desc='SRCF Hiding Experiment'):
+        hiding_ml_experiment(client, **store)
+
+def hiding_srcf_experiment(client, **store):
+    with open_store('bing-srcf_serps_hiding', **store) as serps:
         # Skip any results already written to file
-        if i < skip:
-            continue
-
-        serp = search(engines[technique], srcf_articles[article])
-        serps.append({
-            'query': {
-                'article': article,
-                'technique': technique,
-                'title': srcf_articles[article]
-            },
-            'result': serp
-        })
-        time.sleep(1.25)
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_pickle(filename, serps, srcf_articles)
-
-    # Write final results to file
-    write_pickle(filename, serps, srcf_articles)
-    print(f'Hiding SRCF experiment complete. Results written to {filename}.')
-
-def hiding_ml_experiment():
-    filename = f'bing-ml_serps_hiding-{datetime.now().strftime("%Y-%m-%d")}.pkl'
-    if exists(filename):
-        print('Loading previous ML results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = pickle.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = len(bing_ml_indexed)
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i, (technique, article) in tqdm(enumerate(bing_ml_indexed), total=count, desc='ML Hiding Experiment'):
+        skip = serps.count
+        if skip:
+            print(f'Continuing SRCF experiment after {skip} previous results...')
+        count = len(bing_srcf_indexed)
+
+        todo = bing_srcf_indexed[skip:]
+        searches = (search_params(engines[technique], srcf_articles[article]) for technique, article in todo)
+        for (technique, article), serp in tqdm(zip(todo, client.search_all(searches)), total=count, initial=skip, desc='SRCF Hiding Experiment'):
+            serps.append({
+                'query': {
+                    'article': article,
+                    'technique': technique,
+                    'title': srcf_articles[article]
+                },
+                'result': serp
+            })
+    print(f'Hiding SRCF experiment complete. Results written to {serps.filename}.')
+
+def hiding_ml_experiment(client, **store):
+    with open_store('bing-ml_serps_hiding', **store) as serps:
         # Skip any results already written to file
-        if i < skip:
-            continue
-
-        serp = search(engines[technique], article)
-        serps.append({
-            'query': {
-                'technique': technique,
-                'title': article
-            },
-            'result': serp
-        })
-        time.sleep(1.25)
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_pickle(filename, serps)
-
-    # Write final results to file
-    write_pickle(filename, serps)
-    print(f'Hiding ML experiment complete. Results written to {filename}.')
-
-def surfacing_experiment(srcf: bool, ml: bool) -> None:
+        skip = serps.count
+        if skip:
+            print(f'Continuing ML experiment after {skip} previous results...')
+        count = len(bing_ml_indexed)
+
+        todo = bing_ml_indexed[skip:]
+        searches = (search_params(engines[technique], article) for technique, article in todo)
+        for (technique, article), serp in tqdm(zip(todo, client.search_all(searches)), total=count, initial=skip, desc='ML Hiding Experiment'):
+            serps.append({
+                'query': {
+                    'technique': technique,
+                    'title': article
+                },
+                'result': serp
+            })
+    print(f'Hiding ML experiment complete. Results written to {serps.filename}.')
+
+def surfacing_experiment(client: QueryEngine, srcf: bool, ml: bool, **store) -> None:
     if srcf:
-        surfacing_srcf_experiment()
+        surfacing_srcf_experiment(client, **store)
     if ml:
-        surfacing_ml_experiment()
-
-def surfacing_srcf_experiment():
-    filename = f'bing-srcf_serps_surfacing-{datetime.now().strftime("%Y-%m-%d")}.pkl'
-    if exists(filename):
-        print('Loading previous SRCF results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = pickle.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = len(bing_srcf_indexed)
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i, (technique, article) in tqdm(enumerate(bing_srcf_indexed), total=count, desc='SRCF Surfacing Experiment'):
+        surfacing_ml_experiment(client, **store)
+
+def surfacing_srcf_experiment(client, **store):
+    with open_store('bing-srcf_serps_surfacing', **store) as serps:
         # Skip any results already written to file
-        if i < skip:
-            continue
-
-        perturbed = perturb(srcf_articles[article], technique.replace('srcf-',''))
-        serp = search(engines['srcf-all'], perturbed)
-        serps.append({
-            'query': {
-                'article': article,
-                'technique': technique,
-                'title': perturbed
-            },
-            'result': serp
-        })
-        time.sleep(1.25)
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_pickle(filename, serps, srcf_articles)
-
-    # Write final results to file
-    write_pickle(filename, serps, srcf_articles)
-    print(f'Surfacing SRCF experiment complete. Results written to {filename}.')
-
-def surfacing_ml_experiment():
-    filename = f'bing-ml_serps_surfacing-{datetime.now().strftime("%Y-%m-%d")}.pkl'
-    if exists(filename):
-        print('Loading previous ML results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = pickle.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = len(bing_ml_indexed)
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i, (technique, article) in tqdm(enumerate(bing_ml_indexed), total=count, desc='ML Surfacing Experiment'):
+        skip = serps.count
+        if skip:
+            print(f'Continuing SRCF experiment after {skip} previous results...')
+        count = len(bing_srcf_indexed)
+
+        todo = bing_srcf_indexed[skip:]
+        perturbed = [perturb(srcf_articles[article], technique.replace('srcf-','')) for technique, article in todo]
+        searches = (search_params(engines['srcf-all'], title) for title in perturbed)
+        for (technique, article), title, serp in tqdm(zip(todo, perturbed, client.search_all(searches)), total=count, initial=skip, desc='SRCF Surfacing Experiment'):
+            serps.append({
+                'query': {
+                    'article': article,
+                    'technique': technique,
+                    'title': title
+                },
+                'result': serp
+            })
+    print(f'Surfacing SRCF experiment complete. Results written to {serps.filename}.')
+
+def surfacing_ml_experiment(client, **store):
+    with open_store('bing-ml_serps_surfacing', **store) as serps:
         # Skip any results already written to file
-        if i < skip:
-            continue
-
-        perturbed = perturb(article, technique.replace('ml-',''))
-        serp = search(engines['ml-all'], perturbed)
-        serps.append({
-            'query': {
-                'technique': technique,
-                'title': perturbed,
-                'unperturbed_title': article
-            },
-            'result': serp
-        })
-        time.sleep(1.25)
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_pickle(filename, serps)
-
-    # Write final results to file
-    write_pickle(filename, serps)
-    print(f'Surfacing ML experiment complete. Results written to {filename}.')
-
-def search(engine: str, query: str) -> Dict:
+        skip = serps.count
+        if skip:
+            print(f'Continuing ML experiment after {skip} previous results...')
+        count = len(bing_ml_indexed)
+
+        todo = bing_ml_indexed[skip:]
+        perturbed = [perturb(article, technique.replace('ml-','')) for technique, article in todo]
+        searches = (search_params(engines['ml-all'], title) for title in perturbed)
+        for (technique, article), title, serp in tqdm(zip(todo, perturbed, client.search_all(searches)), total=count, initial=skip, desc='ML Surfacing Experiment'):
+            serps.append({
+                'query': {
+                    'technique': technique,
+                    'title': title,
+                    'unperturbed_title': article
+                },
+                'result': serp
+            })
+    print(f'Surfacing ML experiment complete. Results written to {serps.filename}.')
+
+def search_params(engine: str, query: str) -> Dict:
+  """ Build the parameters for a query against the selected private Bing engine. """
+  return {'q': query, 'customconfig': engine}
+
+def search(client: QueryEngine, engine: str, query: str) -> Dict:
   """ Run the supplied query against the selected private Bing engine. """
-  url =  'https://api.bing.microsoft.com/v7.0/custom/search?'\
-        f'q={query}&customconfig={engine}'
-  headers = {'Ocp-Apim-Subscription-Key': bing_key}
-  return requests.get(url, headers=headers).json()
+  return next(client.search_all([search_params(engine, query)]))
 
-def results(engine: str, query: str) -> int:
+def results(client: QueryEngine, engine: str, query: str) -> int:
   """ Get the number of results for the supplied query against the selected
       private search engine. """
-  return search(engine, query)['searchInformation']['totalResults']
-
-def write_pickle(filename, serps, articles=None):
-    with open(filename, 'wb') as f:
-        if articles:
-            pickle.dump({
-                'articles': articles,
-                'serps': serps
-            }, f)
-        else:
-            pickle.dump({
-                'serps': serps
-            }, f)
\ No newline at end of file
+  return search(client, engine, query)['searchInformation']['totalResults']
@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 from collections import Counter
 from urllib.parse import unquote
 from perturbations import unperturb
+from records import is_record_store, read_records
 
 def graphs(experiment_name: str, srcf_pickle_file: str, ml_pickle_file: str) -> None:
     match experiment_name:
@@ -20,11 +21,10 @@ def graphs(experiment_name: str, srcf_pickle_file: str, ml_pickle_file: str) ->
         case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
 
 def hiding_graphs(srcf_pickle_file: str, ml_pickle_file: str) -> None:
-    # Load the SRCF pickle file
+    # Load the SRCF results file
     srcf_performance = {}
     if srcf_pickle_file:
-        with open(srcf_pickle_file, 'rb') as f:
-            srcf_serps = pickle.load(f)['serps']
+        srcf_serps = load_serps(srcf_pickle_file)
         for technique in ['srcf-base','srcf-zwsp','srcf-zwnj','srcf-zwj','srcf-rlo','srcf-bksp','srcf-del','srcf-homo']:
             srcf_performance[technique] = { 'success': 0, 'total': 0 }
         for serp in srcf_serps:
@@ -37,11 +37,10 @@ def hiding_graphs(srcf_pickle_file: str, ml_pickle_file: str) -> None:
                         if int(url[-1].split('.')[0]) == serp['query']['article']:
                             srcf_performance[technique]['success'] += 1
 
-    # Load the ML pickle file
+    # Load the ML results file
     ml_performance = {}
     if ml_pickle_file:
-        with open(ml_pickle_file, 'rb') as f:
-            ml_serps = pickle.load(f)['serps']
+        ml_serps = load_serps(ml_pickle_file)
         for technique in ['ml-base','ml-zwsp','ml-zwnj','ml-zwj','ml-rlo','ml-bksp','ml-del','ml-homo']:
             ml_performance[technique] = { 'success': 0, 'total': 0 }
         for serp in ml_serps:
@@ -89,11 +88,10 @@ def hiding_graphs(srcf_pickle_file: str, ml_pickle_file: str) -> None:
     print('Hiding bar chart saved to bing_hiding.[svg/png/pdf].')
 
 def surfacing_graphs(srcf_pickle_file: str, ml_pickle_file: str) -> None:
-    # Load the SRCF pickle file
+    # Load the SRCF results file
     srcf_count = Counter()
     if srcf_pickle_file:
-        with open(srcf_pickle_file, 'rb') as f:
-            srcf_serps = pickle.load(f)['serps']
+        srcf_serps = load_serps(srcf_pickle_file)
         for serp in srcf_serps:
             hit = 'miss'
             perturbation, article = '', ''
@@ -111,11 +109,10 @@ def surfacing_graphs(srcf_pickle_file: str, ml_pickle_file: str) -> None:
                         break
             srcf_count[f'{o_perturbation}-{hit}'] += 1
 
-    # Load the ML pickle file
+    # Load the ML results file
     ml_count = Counter()
     if ml_pickle_file:
-        with open(ml_pickle_file, 'rb') as f:
-            ml_serps = pickle.load(f)['serps']
+        ml_serps = load_serps(ml_pickle_file)
         for serp in ml_serps:
             hit = 'miss'
             perturbation, article = '', ''
@@ -152,3 +149,11 @@ def surfacing_graphs(srcf_pickle_file: str, ml_pickle_file: str) -> None:
     plt.savefig('bing_surfacing.png', bbox_inches='tight')
     plt.savefig('bing_surfacing.pdf', bbox_inches='tight')
     print('Surfacing pie charts saved to bing_surfacing.[svg/png/pdf].')
+
+def load_serps(filename: str):
+    """ Yield the SERPs stored in a pickle or JSONL file of experimental results. """
+    if is_record_store(filename):
+        yield from read_records(filename)
+    else:
+        with open(filename, 'rb') as f:
+            yield from pickle.load(f)['serps']
\ No newline at end of file
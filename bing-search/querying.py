@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#
+# querying.py
+# February 2023
+#
+# Rate-limited concurrent client for search engine APIs, built on
+# asyncio and a pooled keep-alive HTTP session.
+#
+import asyncio
+import hashlib
+import json
+import random
+import sqlite3
+import time
+import aiohttp
+from collections import deque
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+
+# Responses worth retrying: rate limited or a transient server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class QuotaExhausted(Exception):
+    """ Raised when a daily or monthly query quota has been used up. """
+
+class CacheMiss(Exception):
+    """ Raised when replaying from the cache and a search has no cached response. """
+
+class ResponseCache():
+    """
+    Persistent cache of search responses in SQLite, keyed by a hash of the
+    API URL and query parameters. Entries older than `ttl` seconds are
+    treated as missing. Counts cache hits and misses.
+    """
+    def __init__(self, filename: str, ttl: float = None):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)')
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url: str, params: dict) -> str:
+        return hashlib.sha256(json.dumps([url, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> dict:
+        row = self.db.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict) -> None:
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, json.dumps(response), time.time()))
+
+    def stats(self) -> str:
+        return f'Response cache: {self.hits} hits, {self.misses} misses.'
+
+    def close(self) -> None:
+        self.db.close()
+
+class QuotaLedger():
+    """
+    Count of the requests sent in each calendar day and month (UTC), kept in
+    SQLite so that quotas hold across runs and concurrent processes. The
+    default in-memory ledger only limits a single run.
+    """
+    def __init__(self, filename: str = ':memory:', per_day: int = None, per_month: int = None):
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS quota (period TEXT PRIMARY KEY, used INTEGER NOT NULL)')
+        self.limits = [('day:%Y-%m-%d', per_day), ('month:%Y-%m', per_month)]
+
+    def take(self) -> bool:
+        """ Record one request, or return False if it would exceed a quota. """
+        now = datetime.now(timezone.utc)
+        periods = [(now.strftime(pattern), limit) for pattern, limit in self.limits]
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            for period, limit in periods:
+                row = self.db.execute('SELECT used FROM quota WHERE period = ?', (period,)).fetchone()
+                if limit and row and row[0] >= limit:
+                    return False
+            for period, _ in periods:
+                self.db.execute('INSERT INTO quota VALUES (?, 1) ON CONFLICT (period) DO UPDATE SET used = used + 1', (period,))
+        finally:
+            self.db.execute('COMMIT')
+        return True
+
+    def close(self) -> None:
+        self.db.close()
+
+class TokenBucket():
+    """
+    Token-bucket rate limiter allowing `per_second` requests per second on
+    average with bursts of up to `burst`. Every request is also recorded in
+    a QuotaLedger, and QuotaExhausted is raised rather than waiting for a
+    daily or monthly quota to reset.
+    """
+    def __init__(self, per_second: float, burst: int = 1, quota: QuotaLedger = None):
+        self.rate = per_second
+        self.capacity = burst
+        self.tokens = burst
+        self.quota = quota
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    async def acquire(self) -> None:
+        # Requests queue on the lock so that tokens are handed out in order
+        async with self.lock:
+            if self.quota is not None and not self.quota.take():
+                raise QuotaExhausted('Query quota exhausted')
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+class QueryEngine():
+    """
+    Runs GET requests against a search API with up to `concurrency` requests
+    in flight over one keep-alive connection pool. Every request (including
+    retries) takes a token from the rate limiter, and responses with a 429 or
+    5xx status are retried up to `retries` times with jittered exponential
+    backoff, honouring any Retry-After header. With a cache, responses are
+    stored and reused across runs (credentials in `params` are not part of
+    the cache key), identical searches in flight at once are sent only once,
+    and `cache_only` replays from the cache without calling the API. Daily
+    and monthly quotas are counted in the `quota_file` SQLite ledger, if
+    given, so that they hold across runs.
+    """
+    def __init__(self, url: str, params: dict = None, headers: dict = None, per_second: float = 3, per_day: int = None,
+                 per_month: int = None, concurrency: int = 8, retries: int = 5, backoff: float = 1.0, timeout: float = 30,
+                 cache: ResponseCache = None, cache_only: bool = False, quota_file: str = None):
+        self.url = url
+        self.params = params or {}
+        self.headers = headers or {}
+        self.per_second = per_second
+        self.per_day = per_day
+        self.per_month = per_month
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if cache_only and cache is None:
+            raise ValueError('Replaying from the cache requires a cache')
+        self.cache = cache
+        self.cache_only = cache_only
+        self.quota_file = quota_file
+
+    async def __aenter__(self) -> 'QueryEngine':
+        self.quota = QuotaLedger(self.quota_file or ':memory:', self.per_day, self.per_month)
+        self.limiter = TokenBucket(self.per_second, quota=self.quota)
+        self.fetching = {}
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.session.close()
+        self.quota.close()
+
+    def search_all(self, searches: Iterable[dict]) -> Iterator[dict]:
+        """ Yield the JSON response to each dict of query parameters, in the
+            order the searches were supplied. """
+        loop = asyncio.new_event_loop()
+        responses = self.run(searches)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(anext(responses))
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(responses.aclose())
+            loop.close()
+
+    async def run(self, searches: Iterable[dict]):
+        async with self:
+            async for response in self.responses(searches):
+                yield response
+
+    async def responses(self, searches: Iterable[dict]):
+        """ Asynchronously yield the JSON response to each dict of query
+            parameters in order. Must be called within `async with`. """
+        pending = deque()
+        try:
+            for params in searches:
+                if len(pending) >= self.concurrency:
+                    yield await pending.popleft()
+                pending.append(asyncio.create_task(self.search(params)))
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def search(self, params: dict) -> dict:
+        """ Run a single search, answering from the cache where possible. """
+        if self.cache is None:
+            return await self.fetch(params)
+        key = self.cache.key(self.url, params)
+        if (response := self.cache.get(key)) is not None:
+            return response
+        if self.cache_only:
+            raise CacheMiss(f'No cached response for {params}')
+        # Share the request for an identical search that is already in flight
+        if key not in self.fetching:
+            self.fetching[key] = asyncio.ensure_future(self.fetch(params))
+        try:
+            response = await self.fetching[key]
+        finally:
+            self.fetching.pop(key, None)
+        self.cache.put(key, response)
+        return response
+
+    async def fetch(self, params: dict) -> dict:
+        """ Run a single search against the API, retrying rate-limited and failed requests. """
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire()
+            try:
+                async with self.session.get(self.url, params={**self.params, **params}) as response:
+                    if response.status not in RETRY_STATUSES or attempt == self.retries:
+                        response.raise_for_status()
+                        return await response.json()
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                retry_after = None
+            delay = self.backoff * 2 ** attempt
+            await asyncio.sleep(float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, delay))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# benchmarking.py
+# December 2022
+#
+# Utilities for checking document perturbation against the original
+# word-by-word implementation, on fixed strings and on real Simple
+# Wikipedia articles. The benchmark should be called from the command
+# line using elastic.py; the check runs on its own as ./benchmarking.py
+#
+import sys
+from itertools import islice
+from time import perf_counter
+from tqdm import tqdm
+from indexing import read_pages, analyze_chunk
+from perturbations import perturbations, perturber, perturb_text, homoglyphs, hg2
+
+# Frozen copy of the word-by-word perturbation used before perturb_text,
+# kept as the reference that document-level perturbation must reproduce.
+# zwsp2 was randomised then, so it is compared with today's perturber().
+def original_perturb(input: str, perturbation: str, title: str = '') -> str:
+    match perturbation:
+        case 'base' : return input
+        case 'zwsp' : return '\u200B'.join(list(input))
+        case 'zwnj' : return '\u200C'.join(list(input))
+        case 'zwj'  : return '\u200D'.join(list(input))
+        case 'rlo'  : return '\u2066\u202E' + input[::-1] + '\u202C\u2069'
+        case 'bksp' : return input[:int(len(input)/2)] + 'X\u0008' + input[int(len(input)/2):]
+        case 'del'  : return input[:int(len(input)/2)] + 'X\u007F' + input[int(len(input)/2):]
+        case 'homo' : return ''.join(map(lambda c: (n := homoglyphs.get_combinations(c))[p if (p := n.index(c)+1) < len(n) else 0], list(input)))
+        case 'zwsp2': return perturber('zwsp2')(input, title)
+        case 'homo2': return ''.join(map(lambda c: hg2[c] if c in hg2 else c, list(input)))
+        case _ : raise NameError(f'Perturbation {perturbation} not found.')
+
+def original_perturb_text(input: str, perturbation: str, title: str = '') -> str:
+    return ' '.join(map(lambda w: original_perturb(w, perturbation, title=title), input.split(' ')))
+
+# Edge cases of splitting on spaces and of the techniques themselves
+FIXED_TEXTS = ['', ' ', '  ', 'a', 'ab', 'abc', 'Hello world', ' leading', 'trailing ', 'double  space', 'tab\tand\nnewline',
+               'X\u0008 X\u007F', '\u200B\u200C\u200D', '\u2066\u202E rtl \u202C\u2069', 'naïve café', 'e\u0301 combining',
+               'Ελληνικά кириллица', '日本語 テキスト', '😀 👍🏽 emoji', 'Hello Hello world world']
+# Codepoint ranges each cut into words of one to seven characters
+CODEPOINT_RANGES = [(0x20, 0x7F), (0xA0, 0x250), (0x370, 0x530), (0x2000, 0x2070), (0x3040, 0x3100), (0xFF00, 0xFF70), (0x1F600, 0x1F650)]
+
+def range_text(start: int, end: int) -> str:
+    chars, words, length = [chr(c) for c in range(start, end)], [], 1
+    while chars:
+        words.append(''.join(chars[:length]))
+        chars, length = chars[length:], length % 7 + 1
+    return ' '.join(words)
+
+def check() -> int:
+    """ Compare perturb_text with the original word-by-word perturbation on
+        fixed strings and codepoint ranges. Returns the number of mismatches. """
+    texts = FIXED_TEXTS + [range_text(start, end) for start, end in CODEPOINT_RANGES] + [''.join(chr(c) for c in range(0x20, 0x7F))]
+    texts.append(' '.join(sorted(homoglyphs.alphabet)))
+    failures = 0
+    for perturbation in perturbations:
+        mismatches = 0
+        for text in texts:
+            for title in (text, 'Hello world'):
+                expected = original_perturb_text(text, perturbation, title)
+                if perturb_text(text, perturbation, title) != expected:
+                    mismatches += 1
+                    print(f'{perturbation}: mismatch on {text[:40]!r} (title {title[:20]!r})')
+        print(f'{perturbation:<10}{2*len(texts)-mismatches:>6} of {2*len(texts)} texts match')
+        failures += mismatches
+    return failures
+
+def benchmark(source, pages=1000):
+    print(f'Loading {pages} articles from {source}...')
+    docs = [doc for doc in map(analyze_chunk, tqdm(islice(read_pages(source), pages), total=pages, desc='Cleaning Articles')) if doc]
+
+    print(f'{"Technique":<10}{"Per-word (s)":>14}{"Document (s)":>14}{"Speedup":>10}{"Mismatches":>12}')
+    for perturbation in perturbations:
+        words_time, text_time, mismatches = 0, 0, 0
+        for doc in docs:
+            start = perf_counter()
+            words = original_perturb_text(doc['body'], perturbation, doc['title'])
+            middle = perf_counter()
+            text = perturb_text(doc['body'], perturbation, doc['title'])
+            end = perf_counter()
+            words_time += middle - start
+            text_time += end - middle
+            mismatches += words != text
+        print(f'{perturbation:<10}{words_time:>14.3f}{text_time:>14.3f}{words_time/max(text_time,1e-9):>9.1f}x{mismatches:>12}')
+
+if __name__ == '__main__':
+    sys.exit(1 if check() else 0)
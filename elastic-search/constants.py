@@ -6,8 +6,6 @@
 #
 SIMPLE_WIKI_URL = 'https://dumps.wikimedia.org/simplewiki/20221201/simplewiki-20221201-pages-articles-multistream.xml.bz2'
 
-TMP_FILE = './simplewiki'
-
 ELASTIC_SETTINGS = {
         "number_of_shards": 2,
         "number_of_replicas": 1
@@ -8,9 +8,12 @@
 #
 import argparse
 from indexing import index
+from constants import SIMPLE_WIKI_URL
 from searching import search
 from experimenting import experiment
 from graphing import graphs
+from benchmarking import benchmark, check
+from localsearch import LocalSearch
 from elasticsearch import Elasticsearch
 
 def main():
@@ -19,10 +22,19 @@ def main():
     parser.add_argument('--host', help='Elasticsearch host', default='localhost')
     parser.add_argument('--port', help='Elasticsearch port', default=9200)
     parser.add_argument('--scheme', help='Elasticsearch scheme', default='http')
+    parser.add_argument('--backend', help='Search backend. Either "elastic" for an Elasticsearch cluster or "local" for the built-in BM25 engine.', choices=['elastic', 'local'], default='elastic')
+    parser.add_argument('--index-dir', help='Directory holding the indices of the local backend.', default='local_index')
+    parser.add_argument('--shared', help='When indexing with the local backend, store the base articles once and index each word-level perturbation as a layer of terms over them.', action='store_true')
     subparsers = parser.add_subparsers(help='Select a command', dest='command', metavar='command', required=True)
     
     #Index Parser
-    subparsers.add_parser('index', help='Index Simple Wikipedia Archive', description='Index Simple Wikipedia Archive')
+    index_parser = subparsers.add_parser('index', help='Index Simple Wikipedia Archive', description='Index Simple Wikipedia Archive')
+    index_parser.add_argument('--dump', help='Path or URL of a bz2-compressed Simple Wikipedia dump.', default=SIMPLE_WIKI_URL)
+    index_parser.add_argument('--chunk-size', help='Number of documents sent per bulk request.', type=int, default=500)
+    index_parser.add_argument('--chunk-bytes', help='Maximum size in bytes of each bulk request.', type=int, default=100*1024*1024)
+    index_parser.add_argument('--requests', help='Number of bulk requests kept in flight.', type=int, default=4)
+    index_parser.add_argument('--workers', help='Number of processes cleaning wikitext (defaults to the CPU count).', type=int)
+    index_parser.add_argument('--unordered', help='Index articles as soon as they are cleaned rather than in dump order.', action='store_true')
     
     # Search Parser
     search_parser = subparsers.add_parser('search', help='Search Simple Wikipedia Index', description='Search Simple Wikipedia Index')
@@ -31,27 +43,47 @@ def main():
     # Experiment Parser
     experiment_parser = subparsers.add_parser('experiment', help='Run Elasticsearch Experiments', description='Run Elasticsearch Experiments')
     experiment_parser.add_argument('experiment_name', help='Experiment to run. Either "hiding", "surfacing", or "all".')
+    experiment_parser.add_argument('--slices', help='Number of slices read in parallel when iterating documents. Resuming an experiment requires the same value.', type=int, default=1)
+    experiment_parser.add_argument('--batch-size', help='Number of queries sent per _msearch request.', type=int, default=100)
+    experiment_parser.add_argument('--in-flight', help='Number of _msearch requests kept in flight.', type=int, default=4)
+    experiment_parser.add_argument('--compress', help='Gzip-compress the results file.', action='store_true')
+    experiment_parser.add_argument('--flush-every', help='Number of results written between flushes of the results file.', type=int, default=1000)
+    experiment_parser.add_argument('--fsync', help='Sync the results file to disk on every flush.', action='store_true')
 
     # Graphs Parser
     graphs_parser = subparsers.add_parser('graphs', help='Build Graphs for Experimental Results', description='Build Graphs for Experimental Results')
     graphs_parser.add_argument('experiment_name', help='Experimental Graphs to Build. Either "hiding", "surfacing", or "all".')
-    graphs_parser.add_argument('json_file', help='JSON file of experimental results for building graphs.')
+    graphs_parser.add_argument('json_file', help='JSON or JSONL file of experimental results for building graphs.')
+    
+    # Benchmark Parser
+    benchmark_parser = subparsers.add_parser('benchmark', help='Benchmark Document Perturbation', description='Benchmark Document Perturbation')
+    benchmark_parser.add_argument('--dump', help='Path or URL of a bz2-compressed Simple Wikipedia dump.', default=SIMPLE_WIKI_URL)
+    benchmark_parser.add_argument('--pages', help='Number of pages to read from the dump.', type=int, default=1000)
+
+    # Check Parser
+    subparsers.add_parser('check', help='Check Document Perturbation against the Original Word-by-Word Perturbation',
+                          description='Check Document Perturbation against the Original Word-by-Word Perturbation. Exits non-zero on any mismatch.')
     
     # Parse arguments
     args = parser.parse_args()
 
     # Connect to Elasticsearch
-    if args.command != 'graphs':
+    if args.command not in ('graphs', 'benchmark', 'check') and args.backend == 'local':
+        elastic = LocalSearch(args.index_dir, shared=args.shared)
+    elif args.command not in ('graphs', 'benchmark', 'check'):
         elastic = Elasticsearch([{'host': args.host, 'port': args.port, 'scheme': args.scheme}], request_timeout=30, max_retries=10, retry_on_timeout=True)
         if not elastic.ping():
             exit('Elasticsearch not running. Please start Elasticsearch and try again.')
 
     # Invoke function to handle verb
     match args.command:
-        case 'index' : index(elastic)
+        case 'index' : index(elastic, args.dump, args.chunk_size, args.chunk_bytes, args.requests, args.workers, not args.unordered)
         case 'search': search(elastic, args.query)
-        case 'experiment': experiment(elastic, args.experiment_name)
+        case 'experiment': experiment(elastic, args.experiment_name, args.slices, args.batch_size, args.in_flight,
+                                              compress=args.compress, flush_every=args.flush_every, fsync=args.fsync)
         case 'graphs': graphs(args.experiment_name, args.json_file)
+        case 'benchmark': benchmark(args.dump, args.pages)
+        case 'check': exit(1 if check() else 0)
         case _ : raise ValueError(f'Unknown verb: {args.command}')
 
 if __name__ == '__main__':
@@ -6,145 +6,177 @@
 # Utilities for searching experimental queries against perturbed
 # Simple Wikipedia. Should be called from the command line using elastic.py.
 #
-import json
 from tqdm.auto import tqdm
-from datetime import datetime
-from os.path import exists
+from queue import Queue, Empty
+from threading import Thread, Event
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from perturbations import unperturb
+from records import open_store
 
-def experiment(elastic, experiment_name):
+def experiment(elastic, experiment_name, slices=1, batch_size=100, in_flight=4, **store):
     match experiment_name:
-        case 'hiding': hiding_experiment(elastic)
-        case 'surfacing': surfacing_experiment(elastic)
-        case 'all': hiding_experiment(elastic); surfacing_experiment(elastic)
+        case 'hiding': hiding_experiment(elastic, slices, batch_size, in_flight, **store)
+        case 'surfacing': surfacing_experiment(elastic, slices, batch_size, in_flight, **store)
+        case 'all': hiding_experiment(elastic, slices, batch_size, in_flight, **store); surfacing_experiment(elastic, slices, batch_size, in_flight, **store)
         case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
 
-def hiding_experiment(elastic):
+def hiding_experiment(elastic, slices=1, batch_size=100, in_flight=4, **store):
     # Run Hiding Experiment
-    filename = f'elastic_serps_hiding-{datetime.now().strftime("%Y-%m-%d")}.json'
-    if exists(filename):
-        print('Loading previous results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = json.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = elastic.count(index='_all', query={ "match_all": {} })['count']
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i,doc in tqdm(enumerate(all_docs(elastic, index='_all')), total=count, desc='Hiding Experiment'):
+    with open_store('elastic_serps_hiding', **store) as serps:
         # Skip any results already written to file
-        if i < skip:
-            continue
+        skip = serps.count
+        if skip:
+            print(f'Continuing experiment after {skip} previous results...')
+        count = elastic.count(index='_all', query={ "match_all": {} })['count']
+        docs = islice(all_docs(elastic, index='_all', slices=slices), skip, None)
+        queries = hiding_queries(docs)
+        for query, serp in tqdm(batched_search(elastic, queries, batch_size, in_flight), total=count, initial=skip, desc='Hiding Experiment'):
+            serps.append({
+                'query': query,
+                'result': dict(serp)
+            })
+    print(f'Hiding experiment complete. Results written to {serps.filename}.')
 
-        # Begin experiment
+def hiding_queries(docs):
+    """ Query each perturbed index for the unperturbed titles of its articles. """
+    for doc in docs:
         technique = doc['_index']
         article = doc['_source']['title']
         title = unperturb(article, technique)
-
-        serp = elastic.search(index=technique, query={
-                "multi_match": {
-                    "query": title, 
-                    "fields": [ "title", "body" ] 
-                }
-            }, source=['title'])
-
-        serps.append({
-            'query': {
-                'article': article,
-                'technique': technique,
-                'title': title
-            },
-            'result': dict(serp)
-        })
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_json(filename, serps)
-
-    # Write final results to file
-    write_json(filename, serps)
-    print(f'Hiding experiment complete. Results written to {filename}.')
-
-
-def surfacing_experiment(elastic):
+        yield {
+            'article': article,
+            'technique': technique,
+            'title': title
+        }, technique, {
+            "multi_match": {
+                "query": title, 
+                "fields": [ "title", "body" ] 
+            }
+        }
+
+
+def surfacing_experiment(elastic, slices=1, batch_size=100, in_flight=4, **store):
     # Run Showing Experiment
-    filename = f'elastic_serps_surfacing-{datetime.now().strftime("%Y-%m-%d")}.json'
-    if exists(filename):
-        print('Loading previous results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = json.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    serps = []
-    filename = f'elastic_serps_surfacing-2-{datetime.now().strftime("%Y-%m-%d")}.json'
-    count = elastic.count(index='_all', query={ "match_all": {} })['count']
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i,doc in tqdm(enumerate(all_docs(elastic, index='_all')), total=count, desc='Surfacing Experiment'):
+    with open_store('elastic_serps_surfacing', **store) as serps:
         # Skip any results already written to file
-        if i < skip:
-            continue
+        skip = serps.count
+        if skip:
+            print(f'Continuing experiment after {skip} previous results...')
+        count = elastic.count(index='_all', query={ "match_all": {} })['count']
+        docs = islice(all_docs(elastic, index='_all', slices=slices), skip, None)
+        queries = surfacing_queries(docs)
+        for query, serp in tqdm(batched_search(elastic, queries, batch_size, in_flight), total=count, initial=skip, desc='Surfacing Experiment'):
+            serps.append({
+                'query': query,
+                'result': dict(serp)
+            })
+    print(f'Surfacing experiment complete. Results written to {serps.filename}.')
 
-        # Begin experiment
+def surfacing_queries(docs):
+    """ Query all indices for the perturbed titles of each article. """
+    for doc in docs:
         technique = doc['_index']
         article = doc['_source']['title']
         title = unperturb(article, technique)
-
-        serp = elastic.search(index='_all', query={
-                "multi_match": {
-                    "query": article, 
-                    "fields": [ "title", "body" ] 
-                }
-            }, source=['title'])
-
-        serps.append({
-            'query': {
-                'article': article,
-                'technique': technique,
-                'title': title
-            },
-            'result': dict(serp)
-        })
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_json(filename, serps)
-
-    # Write final results to file
-    write_json(filename, serps)
-    print(f'Surfacing experiment complete. Results written to {filename}.')
-
-def all_docs(elastic, index, pagesize=1000, scroll_timeout="30m", **kwargs):
+        yield {
+            'article': article,
+            'technique': technique,
+            'title': title
+        }, '_all', {
+            "multi_match": {
+                "query": article, 
+                "fields": [ "title", "body" ] 
+            }
+        }
+
+def batched_search(elastic, queries, batch_size=100, in_flight=4):
     """
-    Helper to iterate ALL values from a single index
+    Run (record, index, query) triples through _msearch in batches of
+    batch_size, keeping up to in_flight batches outstanding at once.
+    Yields (record, response) pairs in the order the queries were supplied.
+    """
+    with ThreadPoolExecutor(in_flight) as pool:
+        pending = deque()
+        while batch := list(islice(queries, batch_size)):
+            if len(pending) >= in_flight:
+                yield from pending.popleft().result()
+            pending.append(pool.submit(msearch, elastic, batch))
+        while pending:
+            yield from pending.popleft().result()
+
+def msearch(elastic, batch):
+    """ Run a batch of (record, index, query) triples as one _msearch request. """
+    searches = []
+    for _, index, query in batch:
+        searches.append({'index': index})
+        searches.append({'query': query, '_source': ['title']})
+    responses = elastic.msearch(searches=searches)['responses']
+    results = []
+    for (record, index, query), response in zip(batch, responses):
+        if 'error' in response: # Retry failed searches individually so errors surface as usual
+            response = elastic.search(index=index, query=query, source=['title'])
+        results.append((record, response))
+    return results
+
+def all_docs(elastic, index, pagesize=1000, keep_alive="30m", slices=1, prefetch=2, **kwargs):
+    """
+    Helper to iterate ALL values from the supplied indices using a
+    point-in-time and search_after. With slices > 1, the indices are
+    split into slices which are each read by their own thread. Every
+    thread fetches up to `prefetch` pages ahead of the consumer, and
+    pages are yielded round-robin across slices so that the order of
+    the documents is the same on every run with the same slices.
     Yields all the documents.
     """
-    is_first = True
-    while True:
-        # Scroll next
-        if is_first: # Initialize scroll
-            result = elastic.search(index=index, scroll=scroll_timeout, **kwargs, body={
-                "size": pagesize,
-                "sort": ["_doc"] # Elasticsearch optimization
-            }, source=['title'])
-            is_first = False
-        else:
-            result = elastic.scroll(body={
-                "scroll_id": scroll_id,
-                "scroll": scroll_timeout
-            })
-        scroll_id = result["_scroll_id"]
-        hits = result["hits"]["hits"]
-        # Stop after no more docs
-        if not hits:
-            break
-        # Yield each entry
-        yield from (hit for hit in hits)
-
-def write_json(filename, serps):
-    with open(filename, 'wb') as f:
-        json.dump({
-            'serps': serps
-        }, f)
\ No newline at end of file
+    pit = elastic.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+    stop = Event()
+    queues = [Queue(maxsize=prefetch) for _ in range(slices)]
+    # The latest PIT id returned to each slice, as every response may update it
+    pits = [pit] * slices
+    threads = [Thread(target=fetch_slice, args=(elastic, pits, i, keep_alive, pagesize, {'id': i, 'max': slices} if slices > 1 else None, queue, stop), kwargs=kwargs, daemon=True)
+               for i, queue in enumerate(queues)]
+    try:
+        for thread in threads:
+            thread.start()
+        active = list(queues)
+        while active:
+            for queue in list(active):
+                hits = queue.get()
+                if hits is None: # Slice exhausted
+                    active.remove(queue)
+                elif isinstance(hits, Exception):
+                    raise hits
+                else:
+                    yield from hits
+    finally:
+        # Unblock any threads still waiting to hand over a page, then release the PIT
+        stop.set()
+        for thread, queue in zip(threads, queues):
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+        for id in dict.fromkeys(pits):
+            elastic.close_point_in_time(id=id, ignore=404)
+
+def fetch_slice(elastic, pits, i, keep_alive, pagesize, slice, queue, stop, **kwargs):
+    """ Page through one slice of a point-in-time, handing each page to the
+        queue and keeping pits[i] at the latest PIT id returned. """
+    try:
+        search_after = None
+        while not stop.is_set():
+            result = elastic.search(pit={'id': pits[i], 'keep_alive': keep_alive}, size=pagesize, sort=['_shard_doc'],
+                                    search_after=search_after, slice=slice, source=['title'], **kwargs)
+            pits[i] = result.get('pit_id', pits[i])
+            hits = result['hits']['hits']
+            if not hits:
+                break
+            queue.put(hits)
+            search_after = hits[-1]['sort']
+    except Exception as oops:
+        queue.put(oops)
+    finally:
+        queue.put(None)
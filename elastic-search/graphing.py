@@ -7,10 +7,17 @@
 # Should be called from the command line using elastic.py.
 #
 import json
+import gzip
+import re
+from os.path import getsize
+from codecs import getincrementaldecoder
 import matplotlib.pyplot as plt
 from tqdm.auto import tqdm
 from collections import Counter
 from perturbations import perturbations, unperturb
+from records import is_record_store, read_records
+
+SEPARATORS = re.compile(r'[\s,]*')
 
 def graphs(experiment_name, json_file):
     match experiment_name:
@@ -20,15 +27,12 @@ def graphs(experiment_name, json_file):
         case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
 
 def hiding_graphs(json_file):
-    # Load the pickle file
-    print('Loading JSON file...')
-    with open(json_file, 'rb') as f:
-        serps = json.load(f)['serps']
+    serps = load_serps(json_file)
     
     performance = {}
     for technique in perturbations:
         performance[technique] = { 'success': 0, 'total': 0 }
-    for serp in tqdm(serps, desc='Processing SERPs'):
+    for serp in serps:
         technique = serp['query']['technique']
         performance[technique]['total'] += 1
         for page in serp['result']['hits']['hits']:
@@ -64,13 +68,10 @@ def hiding_graphs(json_file):
     print('Hiding bar chart saved to elastic_hiding.[svg/png/pdf].')
 
 def surfacing_graphs(json_file):
-    # Load the pickle file
-    print('Loading JSON file...')
-    with open(json_file, 'rb') as f:
-        serps = json.load(f)['serps']
+    serps = load_serps(json_file)
 
     count = Counter()
-    for serp in tqdm(serps, desc='Processing SERPs'):
+    for serp in serps:
         hit = 'miss'
         o_perturbation = serp['query']['technique']
         o_article = serp['query']['article']
@@ -93,4 +94,58 @@ def surfacing_graphs(json_file):
     plt.savefig('elastic_surfacing.svg', bbox_inches='tight')
     plt.savefig('elastic_surfacing.png', bbox_inches='tight')
     plt.savefig('elastic_surfacing.pdf', bbox_inches='tight')
-    print('Surfacing pie charts saved to elastic_surfacing.[svg/png/pdf].')
\ No newline at end of file
+    print('Surfacing pie charts saved to elastic_surfacing.[svg/png/pdf].')
+
+def load_serps(json_file):
+    """ Yield the SERPs stored in a JSON or JSONL file of experimental results. """
+    if is_record_store(json_file):
+        yield from read_records(json_file, progress=True)
+    else:
+        yield from read_json_serps(json_file)
+
+def read_json_serps(json_file, chunk_size=1024*1024):
+    """
+    Incrementally parse the "serps" array of a (optionally gzipped) JSON
+    results file, yielding one SERP at a time so that memory use does not
+    grow with the size of the file. A progress bar reports bytes read.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = getincrementaldecoder('utf-8')()
+    with open(json_file, 'rb') as raw, tqdm(total=getsize(json_file), unit='B', unit_scale=True, desc='Processing SERPs') as pbar:
+        f = gzip.GzipFile(fileobj=raw) if json_file.endswith('.gz') else raw
+        def read():
+            data = f.read(chunk_size)
+            pbar.update(raw.tell() - pbar.n)
+            return utf8.decode(data, final=not data), not data
+
+        # Advance to the start of the SERPs array
+        buffer, eof = '', False
+        while (key := buffer.find('"serps"')) < 0 or (start := buffer.find('[', key)) < 0:
+            if eof:
+                return
+            chunk, eof = read()
+            buffer += chunk
+        pos = start + 1
+
+        while True:
+            # Skip the separators between SERPs, reading more of the file as needed
+            pos = SEPARATORS.match(buffer, pos).end()
+            if pos == len(buffer):
+                if eof:
+                    return
+                buffer, pos = '', 0
+                chunk, eof = read()
+                buffer += chunk
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                serp, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The SERP continues past the end of the buffer
+                if eof:
+                    raise
+                chunk, eof = read()
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield serp
\ No newline at end of file
@@ -8,14 +8,19 @@
 #
 import wikitextparser as wtp
 from html2text import html2text as htt
-from constants import SIMPLE_WIKI_URL, TMP_FILE, ELASTIC_SETTINGS, ELASTIC_MAPPINGS
+from constants import SIMPLE_WIKI_URL, ELASTIC_SETTINGS, ELASTIC_MAPPINGS
 from re import sub
+from typing import Iterator
+from time import perf_counter
+from collections import Counter
 from urllib.request import urlopen
-from os import remove
-from shutil import copyfileobj
-from bz2 import decompress
+from bz2 import BZ2File
+from io import TextIOWrapper
 from tqdm import tqdm
+from elasticsearch.helpers import parallel_bulk
 from perturbations import perturbations, perturb_doc
+from pipeline import parallel_map
+from localsearch import LocalSearch
 
 def dewiki(text):
     text = wtp.parse(text).plain_text()  # wiki to plaintext 
@@ -43,57 +48,91 @@ def analyze_chunk(text):
         print(oops)
         return None
 
-def save_article(elastic, article, id):
-    doc = analyze_chunk(article)
-    if doc:
-        for perturbation in perturbations:
-            elastic.index(index=perturbation, document=perturb_doc(doc, perturbation), id=f'{perturbation}-{id}')
+def analyze_page(page):
+    """ Clean a numbered page chunk. Runs in a pipeline worker process. """
+    id, text = page
+    return id, analyze_chunk(text)
 
-def process_file_text(elastic, filename):
-    article = ''
-    id = 0
-    with open(filename, 'r', encoding='utf-8') as infile:
-        with tqdm(total=223660, desc='Indexing Articles') as pbar:
-            for line in infile:
-                if '<page>' in line:
-                    article = ''
-                elif '</page>' in line:  # end of article
-                    save_article(elastic, article, id)
-                    id += 1
-                    pbar.update(1)
-                else:
-                    article += line                
+def article_actions(docs, derived=()):
+    """ Build one bulk index action per perturbation of each article. Indices
+        derived from the base documents are sent no source, so their
+        perturbations are never computed. """
+    for id, doc in docs:
+        if doc:
+            for perturbation in perturbations:
+                yield {
+                    '_index': perturbation,
+                    '_id': f'{perturbation}-{id}',
+                    '_source': None if perturbation in derived else perturb_doc(doc, perturbation)
+                }
 
-def index(elastic):
-    # Define temp files
-    bz2_temp = TMP_FILE+'.bz2'
-    xml_temp = TMP_FILE+'.xml'
+def read_pages(source: str) -> Iterator[str]:
+    """ Stream the contents of each <page> in a bz2-compressed Wikipedia dump.
+        The archive is read from a local path or URL and decompressed
+        incrementally, so it is never held in memory or written to disk. """
+    raw = urlopen(source) if '://' in source else open(source, 'rb')
+    with raw, TextIOWrapper(BZ2File(raw), encoding='utf-8') as infile:
+        article = []
+        for line in infile:
+            if '<page>' in line:
+                article = []
+            elif '</page>' in line:  # end of article
+                yield ''.join(article)
+            else:
+                article.append(line)
 
-    # Download the Simple Wikipedia dump
-    print("Downloading archive...")
-    with urlopen(SIMPLE_WIKI_URL) as response, open(bz2_temp, 'wb') as bz2:
-        copyfileobj(response, bz2)
+def process_pages(elastic, pages, chunk_size=500, chunk_bytes=100*1024*1024, requests=4, workers=None, ordered=True, derived=()):
+    indexed, first, last = Counter(), {}, {}
+    start = perf_counter()
+    pages = tqdm(pages, total=223660, desc='Indexing Articles')
+    docs = parallel_map(analyze_page, enumerate(pages), workers, ordered)
+    for ok, item in bulk(elastic, article_actions(docs, derived), chunk_size, chunk_bytes, requests):
+        _, result = item.popitem()
+        if ok:
+            # Each index is timed from its first acknowledged document to its last
+            now = perf_counter()
+            first.setdefault(result['_index'], now)
+            last[result['_index']] = now
+            indexed[result['_index']] += 1
+        else:
+            print(result)
+    elapsed = perf_counter() - start
 
-    # Extract the downloaded archive
-    print("Extracting archive...")
-    with open(bz2_temp, 'rb') as bz2, open(xml_temp, 'wb') as xml:
-            xml.write(decompress(bz2.read()))
+    # Report per-index throughput
+    for perturbation in perturbations:
+        if indexed[perturbation]:
+            # An index acknowledged in a single batch is timed from the start of the load
+            span = last[perturbation] - first[perturbation] or last[perturbation] - start
+            print(f'{perturbation}: {indexed[perturbation]} documents in {span:.1f}s ({indexed[perturbation]/span:.0f} docs/sec)')
+        else:
+            print(f'{perturbation}: 0 documents')
+    total = sum(indexed.values())
+    print(f'Indexed {total} documents in {elapsed:.0f}s ({total/elapsed:.0f} docs/sec)')
 
-    # Delete compressed temp file
-    print("Removing compressed archive...")
-    remove(bz2_temp)
+def bulk(elastic, actions, chunk_size=500, chunk_bytes=100*1024*1024, requests=4):
+    """ Index the bulk actions, yielding an (ok, item) pair for each. """
+    if isinstance(elastic, LocalSearch):
+        return elastic.bulk_actions(actions)
+    return parallel_bulk(elastic, actions, thread_count=requests, queue_size=requests,
+                         chunk_size=chunk_size, max_chunk_bytes=chunk_bytes, raise_on_error=False)
 
+def index(elastic, source=SIMPLE_WIKI_URL, chunk_size=500, chunk_bytes=100*1024*1024, requests=4, workers=None, ordered=True):
     print("Creating ElasticSearch Indices...")
     for perturbation in perturbations:
         elastic.indices.create(index=perturbation, settings=ELASTIC_SETTINGS, mappings=ELASTIC_MAPPINGS, ignore=400)
+    # Refreshing is disabled during the bulk load and restored afterwards, including on indices that already existed
+    elastic.indices.put_settings(index=','.join(perturbations), settings={"refresh_interval": "-1"})
 
-    # Process WikiXML into SQL
-    print("Loading data into ElasticSearch Index...")
-    process_file_text(elastic, xml_temp)
-
-    # Delete decompressed temp file
-    print("Removing extracted archive...")
-    remove(xml_temp)
+    # Stream WikiXML pages from the archive into the index
+    print(f"Loading data from {source} into ElasticSearch Index...")
+    derived = elastic.derived() if isinstance(elastic, LocalSearch) else set()
+    try:
+        process_pages(elastic, read_pages(source), chunk_size, chunk_bytes, requests, workers, ordered, derived)
+    finally:
+        # Restored even if the load fails, so no index is left without refreshes
+        print("Refreshing ElasticSearch Indices...")
+        elastic.indices.put_settings(index=','.join(perturbations), settings={"refresh_interval": None})
+        elastic.indices.refresh(index=','.join(perturbations))
 
     # Confirm success
     print(f'Successfully built Simple Wikipedia Elasticsearch Index.')
\ No newline at end of file
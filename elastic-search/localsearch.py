@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+#
+# localsearch.py
+# December 2022
+#
+# Pure-Python stand-in for Elasticsearch, scoring multi_match queries
+# with BM25 over memory-mapped on-disk index segments. Implements the
+# subset of the Elasticsearch client used by elastic.py, so that
+# experiments can run on one machine without a cluster.
+#
+import re
+import json
+import mmap
+import numpy as np
+from os import makedirs, replace, listdir
+from os.path import join, exists, getsize
+from math import log
+from array import array
+from shutil import rmtree
+from itertools import count
+from collections import Counter
+from perturbations import perturb, perturb_text, word_perturbations
+
+# Word characters, plus the invisible format characters (other than the
+# zero width space) that Unicode word segmentation keeps inside words
+TOKEN = re.compile(r'[\w\u00ad\u200c-\u200f\u202a-\u202e\u2060-\u2064\u2066-\u206f\ufeff]+')
+WORD = re.compile(r'\w')
+
+# BM25 parameters, matching the Elasticsearch defaults
+K1 = 1.2
+B = 0.75
+
+FIELDS = ('title', 'body')
+STORED = ('title', 'article-id')
+
+# Elasticsearch index names cannot start with an underscore, so the shared
+# base corpus can never clash with an index
+WORDS = '_words'
+
+def analyze(text: str) -> list:
+    """ Approximation of the Elasticsearch standard analyzer: Unicode word tokens, lowercased. """
+    return [token for token in TOKEN.findall(text.lower()) if token.isalnum() or WORD.search(token)]
+
+def split_words(text: str) -> list:
+    """ The space-separated words of a text, which perturbations act on one at a time. """
+    return text.split(' ')
+
+def encode_varints(values: np.ndarray) -> tuple[bytes, np.ndarray]:
+    """ LEB128-encode unsigned integers, returning the bytes and the encoded length of each value. """
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= (1 << shift)
+    ends = np.cumsum(lengths)
+    owner = np.repeat(np.arange(len(values)), lengths)
+    group = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths, lengths)
+    data = (values[owner] >> (7 * group).astype(np.uint64)) & 0x7f
+    data |= (group < lengths[owner] - 1).astype(np.uint64) << 7
+    return data.astype(np.uint8).tobytes(), lengths
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """ Decode a buffer of LEB128-encoded unsigned integers. """
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    return np.add.reduceat((data & 0x7f).astype(np.uint64) << (7 * group).astype(np.uint64), starts)
+
+def gather_varints(data, offsets: np.ndarray, numbers: np.ndarray) -> np.ndarray:
+    """ Decode the varints between offsets[n] and offsets[n+1] for each of the numbers, concatenated. """
+    starts = offsets[numbers].astype(np.int64)
+    lengths = offsets[numbers + 1].astype(np.int64) - starts
+    ends = np.cumsum(lengths)
+    index = np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+    return decode_varints(np.frombuffer(data, dtype=np.uint8)[index])
+
+def find_term(terms, offsets: np.ndarray, term: str) -> int:
+    """ Binary search a sorted term dictionary, returning the term's number or None. """
+    encoded = term.encode('utf-8')
+    low, high = 0, len(offsets) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if terms[int(offsets[middle]):int(offsets[middle + 1])] < encoded:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(offsets) - 1 and terms[int(offsets[low]):int(offsets[low + 1])] == encoded:
+        return low
+    return None
+
+def write_terms(path: str, field: str, terms: list) -> None:
+    """ Write a term dictionary of UTF-8 encoded terms, which must be sorted by their encodings. """
+    encoded = [term.encode('utf-8') for term in terms]
+    with open(join(path, f'{field}.terms'), 'wb') as f:
+        f.write(b''.join(encoded))
+    save_array(join(path, f'{field}.term_offsets.npy'), np.cumsum([0] + [len(term) for term in encoded], dtype=np.uint64))
+
+def map_file(filename: str):
+    """ Memory-map a file read-only (empty files cannot be mapped). """
+    if not getsize(filename):
+        return b''
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def save_array(filename: str, values: np.ndarray) -> None:
+    # Written to a temporary file and renamed, as the old file may still be mapped
+    with open(filename + '.tmp', 'wb') as f:
+        np.save(f, values)
+    replace(filename + '.tmp', filename)
+
+class SegmentWriter():
+    """
+    Accumulates documents in memory, in growable arrays of postings for each
+    term, until they are written out as an immutable on-disk segment.
+    """
+    def __init__(self, fields: tuple = FIELDS, stored: tuple = STORED, analyzer=analyze):
+        self.fields = fields
+        self.stored = stored
+        self.analyzer = analyzer
+        self.documents = []
+        self.lengths = {field: array('I') for field in fields}
+        self.postings = {field: {} for field in fields}
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add(self, id: str, source: dict) -> None:
+        doc = len(self.documents)
+        self.documents.append([id, {key: source[key] for key in self.stored if key in source}])
+        for field in self.fields:
+            terms = Counter(self.analyzer(source.get(field, '')))
+            self.lengths[field].append(sum(terms.values()))
+            postings = self.postings[field]
+            for term, freq in terms.items():
+                if term not in postings:
+                    postings[term] = (array('I'), array('I'))
+                docs, freqs = postings[term]
+                docs.append(doc)
+                freqs.append(freq)
+
+    def write(self, path: str) -> None:
+        """
+        Write the segment to a directory. For each field this holds a term
+        dictionary sorted by UTF-8 bytes, the document frequency of every term,
+        its postings as varint-encoded document number deltas and frequencies,
+        and the length of every document as an array. Stored fields are kept
+        as JSON lines indexed by their offsets.
+        """
+        makedirs(path)
+        lines = [json.dumps(document).encode('utf-8') + b'\n' for document in self.documents]
+        with open(join(path, 'stored.jsonl'), 'wb') as f:
+            f.writelines(lines)
+        save_array(join(path, 'stored.offsets.npy'), np.cumsum([0] + [len(line) for line in lines], dtype=np.uint64))
+        for field in self.fields:
+            terms = sorted(self.postings[field], key=lambda term: term.encode('utf-8'))
+            write_terms(path, field, terms)
+            postings = [self.postings[field][term] for term in terms]
+            df = np.array([len(docs) for docs, _ in postings], dtype=np.uint32)
+            save_array(join(path, f'{field}.df.npy'), df)
+            docs = np.concatenate([np.frombuffer(docs, dtype=np.uint32) for docs, _ in postings] or [np.zeros(0, np.uint32)]).astype(np.int64)
+            freqs = np.concatenate([np.frombuffer(freqs, dtype=np.uint32) for _, freqs in postings] or [np.zeros(0, np.uint32)])
+            # Delta-encode document numbers within each term's postings
+            firsts = np.cumsum(df, dtype=np.int64) - df
+            deltas = np.diff(docs, prepend=0)
+            deltas[firsts] = docs[firsts]
+            for name, values in (('docs', deltas), ('freqs', freqs)):
+                data, lengths = encode_varints(values)
+                with open(join(path, f'{field}.{name}'), 'wb') as f:
+                    f.write(data)
+                # Byte offset of the start of each term's postings, plus the end
+                ends = np.concatenate(([0], np.cumsum(lengths, dtype=np.uint64)))
+                save_array(join(path, f'{field}.{name}_offsets.npy'), ends[np.concatenate((firsts, [len(docs)]))])
+            save_array(join(path, f'{field}.lengths.npy'), np.frombuffer(self.lengths[field], dtype=np.uint32))
+
+class Segment():
+    """
+    Read-only view of an on-disk segment. Every file is memory-mapped, so
+    opening a segment reads almost nothing, and processes searching the same
+    index share its pages through the OS page cache.
+    """
+    def __init__(self, path: str, fields: tuple = FIELDS):
+        self.path = path
+        self.fields = fields
+        self.stored = map_file(join(path, 'stored.jsonl'))
+        self.offsets = np.load(join(path, 'stored.offsets.npy'), mmap_mode='r')
+        self.terms, self.term_offsets, self.df, self.lengths = {}, {}, {}, {}
+        self.postings = {}
+        for field in fields:
+            self.terms[field] = map_file(join(path, f'{field}.terms'))
+            self.term_offsets[field] = np.load(join(path, f'{field}.term_offsets.npy'), mmap_mode='r')
+            self.df[field] = np.load(join(path, f'{field}.df.npy'), mmap_mode='r')
+            self.lengths[field] = np.load(join(path, f'{field}.lengths.npy'), mmap_mode='r')
+            self.postings[field] = [(map_file(join(path, f'{field}.{name}')), np.load(join(path, f'{field}.{name}_offsets.npy'), mmap_mode='r'))
+                                    for name in ('docs', 'freqs')]
+        self.load_norms()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def load_norms(self) -> None:
+        self.norms = {field: np.load(join(self.path, f'{field}.norms.npy'), mmap_mode='r')
+                      for field in self.fields if exists(join(self.path, f'{field}.norms.npy'))}
+
+    def vocabulary(self, field: str) -> list:
+        terms, offsets = self.terms[field], self.term_offsets[field].astype(np.int64)
+        return [terms[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def read_postings(self, field: str, numbers: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ Decode the document numbers and frequencies of each of the numbered terms, concatenated. """
+        (docs, doc_offsets), (freqs, freq_offsets) = self.postings[field]
+        counts = self.df[field][numbers].astype(np.int64)
+        deltas = gather_varints(docs, doc_offsets, numbers).astype(np.int64)
+        # Undo the delta encoding, restarting at the first posting of each term
+        docs = np.cumsum(deltas)
+        firsts = np.cumsum(counts) - counts
+        docs -= np.repeat(docs[firsts] - deltas[firsts], counts)
+        return docs, gather_varints(freqs, freq_offsets, numbers).astype(np.float32)
+
+    def find(self, field: str, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """ The document numbers and frequencies of a term, or None. """
+        number = find_term(self.terms[field], self.term_offsets[field], term)
+        return None if number is None else self.read_postings(field, np.array([number]))
+
+    def document(self, doc: int) -> tuple[str, dict]:
+        id, source = json.loads(self.stored[int(self.offsets[doc]):int(self.offsets[doc + 1])])
+        return id, source
+
+class LocalIndex():
+    """
+    An index made of immutable on-disk segments. Added documents are buffered
+    by a SegmentWriter, which is written out as a new segment every
+    `segment_docs` documents so memory use stays bounded while indexing.
+    Refreshing writes out any remaining documents and the BM25 length norms
+    of every segment, which depend on the average lengths across the index.
+    """
+    def __init__(self, path: str, segment_docs: int = 50000, analyzer=analyze):
+        self.path = path
+        self.name = path.rstrip('/').split('/')[-1]
+        self.segment_docs = segment_docs
+        self.analyzer = analyzer
+        self.writer = SegmentWriter(analyzer=analyzer)
+        makedirs(path, exist_ok=True)
+        self.segments = [Segment(join(path, name)) for name in sorted(listdir(path)) if name.startswith('segment-')]
+        self.bases = np.cumsum([0] + [len(segment) for segment in self.segments])
+
+    def __len__(self) -> int:
+        return int(self.bases[-1])
+
+    def add(self, id: str, source: dict) -> None:
+        self.writer.add(id, source)
+        if len(self.writer) >= self.segment_docs:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Write the buffered documents out as a new segment. """
+        if not len(self.writer):
+            return
+        path = join(self.path, f'segment-{len(self.segments):05d}')
+        self.writer.write(path)
+        self.writer = SegmentWriter(analyzer=self.analyzer)
+        self.segments.append(Segment(path))
+        self.bases = np.cumsum([0] + [len(segment) for segment in self.segments])
+
+    def refresh(self) -> None:
+        """ Make all added documents searchable. """
+        self.flush()
+        for field in FIELDS:
+            total = sum(int(segment.lengths[field].sum(dtype=np.uint64)) for segment in self.segments)
+            average = max(total / max(len(self), 1), 1e-9)
+            for segment in self.segments:
+                save_array(join(segment.path, f'{field}.norms.npy'), (K1 * (1 - B + B * segment.lengths[field] / average)).astype(np.float32))
+        for segment in self.segments:
+            segment.load_norms()
+
+    def scores(self, terms: Counter, fields: list) -> np.ndarray:
+        """ BM25 score of every document for a best_fields multi_match of the
+            query terms, taking the best scoring field of each document. """
+        best = np.zeros(len(self), dtype=np.float32)
+        for field, boost in fields:
+            scores = np.zeros_like(best)
+            for term, repeats in terms.items():
+                # Document frequencies are summed over segments before scoring
+                postings = []
+                for base, segment in zip(self.bases, self.segments):
+                    if (found := segment.find(field, term)) is not None:
+                        docs, freqs = found
+                        postings.append((docs + base, freqs, segment.norms[field][docs]))
+                df = sum(len(docs) for docs, _, _ in postings)
+                idf = log(1 + (len(self) - df + 0.5) / (df + 0.5))
+                for docs, freqs, norms in postings:
+                    scores[docs] += (boost * repeats * idf) * freqs / (freqs + norms)
+            np.maximum(best, scores, out=best)
+        return best
+
+    def document(self, doc: int) -> tuple[str, dict]:
+        """ The id and stored fields of a document, numbered across segments. """
+        segment = int(np.searchsorted(self.bases, doc, side='right')) - 1
+        return self.segments[segment].document(doc - int(self.bases[segment]))
+
+class LayerSegment():
+    """
+    Terms of a perturbed index over one segment of the shared corpus, which
+    indexes the space-separated words of the base documents. Each field has a
+    dictionary mapping every term of the perturbed words to the corpus words
+    it comes from and the number of times it occurs in each, along with the
+    perturbed document lengths and norms.
+    """
+    def __init__(self, path: str, corpus: Segment, fields: tuple = FIELDS):
+        self.path = path
+        self.corpus = corpus
+        self.fields = fields
+        self.terms, self.term_offsets, self.words, self.word_offsets, self.repeats, self.lengths = {}, {}, {}, {}, {}, {}
+        for field in fields:
+            self.terms[field] = map_file(join(path, f'{field}.terms'))
+            self.term_offsets[field] = np.load(join(path, f'{field}.term_offsets.npy'), mmap_mode='r')
+            self.words[field] = np.load(join(path, f'{field}.words.npy'), mmap_mode='r')
+            self.word_offsets[field] = np.load(join(path, f'{field}.word_offsets.npy'), mmap_mode='r')
+            self.repeats[field] = np.load(join(path, f'{field}.repeats.npy'), mmap_mode='r')
+            self.lengths[field] = np.load(join(path, f'{field}.lengths.npy'), mmap_mode='r')
+        self.load_norms()
+
+    def __len__(self) -> int:
+        return len(self.corpus)
+
+    load_norms = Segment.load_norms
+
+    @staticmethod
+    def write(path: str, corpus: Segment, perturbation: str) -> None:
+        """ Perturb and analyze every word of a corpus segment, writing the resulting layer. """
+        rmtree(path + '.tmp', ignore_errors=True)
+        makedirs(path + '.tmp')
+        for field in corpus.fields:
+            layer = {}
+            tokens = np.zeros(len(corpus.df[field]), dtype=np.int64)
+            for word, text in enumerate(corpus.vocabulary(field)):
+                # Terms of the word as it appears in the perturbed text
+                terms = Counter(analyze(perturb(text, perturbation)))
+                tokens[word] = sum(terms.values())
+                for term, repeats in terms.items():
+                    layer.setdefault(term, []).append((word, repeats))
+            terms = sorted(layer, key=lambda term: term.encode('utf-8'))
+            write_terms(path + '.tmp', field, terms)
+            save_array(join(path + '.tmp', f'{field}.words.npy'), np.array([word for term in terms for word, _ in layer[term]], dtype=np.uint32))
+            save_array(join(path + '.tmp', f'{field}.repeats.npy'), np.array([repeats for term in terms for _, repeats in layer[term]], dtype=np.uint16))
+            save_array(join(path + '.tmp', f'{field}.word_offsets.npy'), np.cumsum([0] + [len(layer[term]) for term in terms], dtype=np.uint64))
+            # Perturbed length of each document, from the number of terms in each of its words
+            words = np.arange(len(tokens))
+            docs, freqs = corpus.read_postings(field, words)
+            weights = freqs * np.repeat(tokens, corpus.df[field][words].astype(np.int64))
+            save_array(join(path + '.tmp', f'{field}.lengths.npy'), np.bincount(docs, weights, minlength=len(corpus)).astype(np.uint32))
+        # Only complete layers are renamed into place
+        replace(path + '.tmp', path)
+
+    def find(self, field: str, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """ The document numbers and frequencies of a term, merged from the postings of its words, or None. """
+        number = find_term(self.terms[field], self.term_offsets[field], term)
+        if number is None:
+            return None
+        start, end = int(self.word_offsets[field][number]), int(self.word_offsets[field][number + 1])
+        words = np.asarray(self.words[field][start:end], dtype=np.int64)
+        docs, freqs = self.corpus.read_postings(field, words)
+        freqs *= np.repeat(self.repeats[field][start:end], self.corpus.df[field][words].astype(np.int64))
+        freqs = np.bincount(docs, freqs, minlength=len(self))
+        docs = np.flatnonzero(freqs)
+        return docs, freqs[docs].astype(np.float32)
+
+class LayerIndex(LocalIndex):
+    """
+    Index of the perturbed base documents which stores only a term layer over
+    the shared corpus of base words, for techniques that perturb each word
+    independently of its document. Searches see the terms Elasticsearch
+    would index for the perturbed text, while the corpus and its postings are
+    stored once however many techniques are layered over it. Documents are
+    added to the corpus, by the base index, and each layer is built for the
+    corpus segments missing it when the index is refreshed.
+    """
+    def __init__(self, path: str, corpus: LocalIndex, perturbation: str):
+        self.path = path
+        self.name = path.rstrip('/').split('/')[-1]
+        self.corpus = corpus
+        self.perturbation = perturbation
+        makedirs(path, exist_ok=True)
+        with open(join(path, 'layer.json'), 'w') as f:
+            json.dump({'perturbation': perturbation}, f)
+        self.load()
+
+    def load(self) -> None:
+        self.segments = [LayerSegment(join(self.path, corpus.path.split('/')[-1]), corpus)
+                         for corpus in self.corpus.segments if exists(join(self.path, corpus.path.split('/')[-1]))]
+        self.bases = np.cumsum([0] + [len(segment) for segment in self.segments])
+
+    def add(self, id: str, source: dict) -> None:
+        # Perturbed indices are derived from the corpus, so only the base documents are added
+        if source is not None:
+            self.corpus.add(id, source)
+
+    def flush(self) -> None:
+        """ Build the layer for every corpus segment not yet layered. """
+        self.corpus.flush()
+        for corpus in self.corpus.segments[len(self.segments):]:
+            LayerSegment.write(join(self.path, corpus.path.split('/')[-1]), corpus, self.perturbation)
+        self.load()
+
+    def document(self, doc: int) -> tuple[str, dict]:
+        id, source = self.corpus.document(doc)
+        # Ids are the technique followed by the article number
+        id = self.name + id[id.index('-'):]
+        if 'title' in source:
+            source = {**source, 'title': perturb_text(source['title'], self.perturbation, source['title'])}
+        return id, source
+
+class LocalIndices():
+    """ Index management endpoints of LocalSearch, mirroring Elasticsearch.indices. """
+    def __init__(self, client: 'LocalSearch'):
+        self.client = client
+
+    def create(self, index: str, **kwargs) -> dict:
+        # Recreating an index replaces it, which keeps re-indexing idempotent
+        client = self.client
+        rmtree(join(client.path, index), ignore_errors=True)
+        if client.shared and index in word_perturbations:
+            if index == 'base':
+                # The base index owns the corpus, so every layer over it is rebuilt
+                rmtree(join(client.path, WORDS), ignore_errors=True)
+                client.words = LocalIndex(join(client.path, WORDS), client.segment_docs, split_words)
+                for name, local in client.indexes.items():
+                    if isinstance(local, LayerIndex):
+                        rmtree(local.path)
+                        client.indexes[name] = LayerIndex(local.path, client.words, local.perturbation)
+            client.indexes[index] = LayerIndex(join(client.path, index), client.words, index)
+        else:
+            client.indexes[index] = LocalIndex(join(client.path, index), client.segment_docs)
+        return {'acknowledged': True, 'index': index}
+
+    def put_settings(self, **kwargs) -> dict:
+        return {'acknowledged': True}
+
+    def refresh(self, index: str = '_all', **kwargs) -> dict:
+        """ Write out added documents and make them searchable. """
+        for local in self.client.resolve(index):
+            local.refresh()
+        return {'_shards': {'failed': 0}}
+
+class LocalSearch():
+    """
+    Local replacement for the Elasticsearch client supporting the calls made
+    by elastic.py: creating, bulk loading and refreshing indices, match_all and
+    multi_match searches (singly or through msearch), counts, and iterating
+    documents with a point-in-time, search_after and slices. Each index is a
+    directory of segments under `path`, opened by memory-mapping them. With
+    `shared`, indices created for techniques which perturb words independently
+    are layers over one shared corpus of the base documents.
+    """
+    def __init__(self, path: str = 'local_index', segment_docs: int = 50000, shared: bool = False):
+        self.path = path
+        self.segment_docs = segment_docs
+        self.shared = shared
+        self.pits = {}
+        self.pit_ids = count()
+        self.indices = LocalIndices(self)
+        makedirs(path, exist_ok=True)
+        self.words = LocalIndex(join(path, WORDS), segment_docs, split_words) if shared or exists(join(path, WORDS)) else None
+        self.indexes = {}
+        for name in sorted(listdir(path)):
+            if name.startswith('_'):
+                continue
+            if exists(join(path, name, 'layer.json')):
+                with open(join(path, name, 'layer.json')) as f:
+                    self.indexes[name] = LayerIndex(join(path, name), self.words, json.load(f)['perturbation'])
+            else:
+                self.indexes[name] = LocalIndex(join(path, name), segment_docs)
+
+    def derived(self) -> set:
+        """ Names of the indices derived from the base documents, which need no documents of their own. """
+        return {name for name, local in self.indexes.items() if isinstance(local, LayerIndex) and local.perturbation != 'base'}
+
+    def ping(self) -> bool:
+        return True
+
+    def resolve(self, index: str) -> list:
+        """ The indices named by a comma-separated list, or all of them for _all. """
+        if index in (None, '_all', '*'):
+            return list(self.indexes.values())
+        try:
+            return [self.indexes[name] for name in index.split(',')]
+        except KeyError as oops:
+            raise ValueError(f'no such index [{oops.args[0]}]')
+
+    def bulk_actions(self, actions):
+        """ Index a stream of bulk index actions, yielding (ok, item) pairs like
+            elasticsearch.helpers.parallel_bulk. """
+        for action in actions:
+            self.indexes[action['_index']].add(action['_id'], action['_source'])
+            yield True, {'index': {'_index': action['_index'], '_id': action['_id'], 'status': 201}}
+
+    def count(self, index: str = '_all', query: dict = None, **kwargs) -> dict:
+        if not query or 'match_all' in query:
+            return {'count': sum(len(local) for local in self.resolve(index))}
+        return {'count': self.search(index=index, query=query, size=0)['hits']['total']['value']}
+
+    def open_point_in_time(self, index: str, keep_alive: str = None, **kwargs) -> dict:
+        id = str(next(self.pit_ids))
+        self.pits[id] = self.resolve(index)
+        return {'id': id}
+
+    def close_point_in_time(self, id: str, **kwargs) -> dict:
+        return {'succeeded': self.pits.pop(id, None) is not None, 'num_freed': 1}
+
+    def msearch(self, searches: list, **kwargs) -> dict:
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                response = self.search(index=header.get('index'), query=body.get('query'),
+                                       size=body.get('size', 10), source=body.get('_source'))
+                responses.append({**response, 'status': 200})
+            except ValueError as oops:
+                responses.append({'error': {'type': 'illegal_argument_exception', 'reason': str(oops)}, 'status': 400})
+        return {'responses': responses}
+
+    def search(self, index: str = '_all', query: dict = None, size: int = 10, source=None, pit: dict = None,
+               search_after: list = None, slice: dict = None, **kwargs) -> dict:
+        if pit is not None:
+            return self.page(self.pits[pit['id']], size, source, search_after, slice, pit['id'])
+        locals = self.resolve(index)
+        if not query or 'match_all' in query:
+            return self.page(locals, size, source)
+        if 'multi_match' not in query:
+            raise ValueError(f'Unsupported query: {list(query)}')
+        terms = Counter(analyze(query['multi_match']['query']))
+        fields = []
+        for field in query['multi_match'].get('fields', ['title', 'body']):
+            name, _, boost = field.partition('^')
+            fields.append((name, float(boost or 1)))
+        total, candidates = 0, []
+        for position, local in enumerate(locals):
+            scores = local.scores(terms, fields)
+            matched = np.flatnonzero(scores)
+            total += len(matched)
+            if len(matched) > size:
+                matched = matched[np.argpartition(-scores[matched], size - 1)[:size]] if size else matched[:0]
+            candidates.extend((-float(scores[doc]), position, int(doc)) for doc in matched)
+        candidates.sort()
+        hits = [self.hit(locals[position], doc, source, -score) for score, position, doc in candidates[:size]]
+        return {'hits': {'total': {'value': total, 'relation': 'eq'}, 'max_score': hits[0]['_score'] if hits else None, 'hits': hits}}
+
+    def page(self, locals: list, size: int, source, search_after: list = None, slice: dict = None, pit: str = None) -> dict:
+        """ A page of documents in index order, each sorted by its position. """
+        offsets = [0]
+        for local in locals:
+            offsets.append(offsets[-1] + len(local))
+        step = slice['max'] if slice else 1
+        start = search_after[0] + 1 if search_after else 0
+        if slice: # Round up to the next position within the slice
+            start += (slice['id'] - start) % step
+        hits, position = [], 0
+        for sort in range(start, offsets[-1], step):
+            if len(hits) == size:
+                break
+            while sort >= offsets[position + 1]:
+                position += 1
+            hits.append(self.hit(locals[position], sort - offsets[position], source, 1.0, [sort]))
+        response = {'hits': {'total': {'value': offsets[-1], 'relation': 'eq'}, 'max_score': 1.0 if hits else None, 'hits': hits}}
+        if pit is not None:
+            response['pit_id'] = pit
+        return response
+
+    def hit(self, local: LocalIndex, doc: int, source, score: float, sort: list = None) -> dict:
+        id, stored = local.document(doc)
+        if source is False:
+            stored = {}
+        elif isinstance(source, (list, tuple)):
+            stored = {key: stored[key] for key in source if key in stored}
+        hit = {'_index': local.name, '_id': id, '_score': score, '_source': stored}
+        if sort is not None:
+            hit['sort'] = sort
+        return hit
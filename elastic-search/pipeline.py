@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+#
+# pipeline.py
+# December 2022
+#
+# Utilities for spreading CPU-bound article processing across
+# a pool of worker processes.
+#
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os import cpu_count
+from typing import Callable, Iterable, Iterator
+
+def parallel_map(func: Callable, items: Iterable, workers: int = None, ordered: bool = True, buffer: int = None) -> Iterator:
+    """ Apply func to each item on a pool of worker processes and yield the results.
+        At most `buffer` items are in flight at any time, so a slow consumer holds
+        back the reader rather than letting results pile up in memory. Results are
+        yielded in input order unless `ordered` is False. """
+    workers = workers or cpu_count()
+    if workers == 1:
+        yield from map(func, items)
+        return
+    buffer = buffer or workers * 4
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque() if ordered else set()
+        for item in items:
+            if len(pending) >= buffer:
+                yield from _drain(pending, ordered)
+            future = pool.submit(func, item)
+            pending.append(future) if ordered else pending.add(future)
+        while pending:
+            yield from _drain(pending, ordered)
+
+def _drain(pending, ordered: bool) -> Iterator:
+    """ Yield the next available result(s) from the in-flight futures. """
+    if ordered:
+        yield pending.popleft().result()
+    else:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            yield future.result()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# records.py
+# December 2022
+#
+# Append-only storage of experimental results as JSON lines,
+# optionally gzip-compressed.
+#
+import gzip
+import json
+import zlib
+from os import fsync, replace, truncate
+from os.path import exists, getsize
+from typing import Iterator
+from datetime import datetime
+from tqdm.auto import tqdm
+
+class RecordStore():
+    """
+    Appends JSON records to a JSONL file (gzip-compressed if the filename ends
+    in .gz). Records are buffered and written out in batches: every
+    `flush_every` records the file is flushed (ending a gzip member),
+    optionally fsynced, and a small sidecar index recording the number of
+    records and the file size is updated. Reopening the store resumes from the
+    sidecar in O(1), discarding anything written after the last flush. Without
+    a sidecar, the file is scanned and cut back to its last complete record.
+    """
+    def __init__(self, filename: str, flush_every: int = 1000, fsync: bool = False):
+        self.filename = filename
+        self.index = filename + '.idx'
+        self.flush_every = flush_every
+        self.fsync = fsync
+        self.compressed = filename.endswith('.gz')
+        if exists(self.index):
+            self.count, offset = read_index(self.index)
+            truncate(filename, offset)
+        elif exists(filename):
+            # No index yet, so count the records already in the file
+            self.count, offset = scan_records(filename)
+            truncate(filename, offset)
+        else:
+            self.count = 0
+        self.file = open(filename, 'ab')
+        self.stream = self.open_stream()
+        self.pending = 0
+
+    def open_stream(self):
+        return gzip.GzipFile(fileobj=self.file, mode='ab') if self.compressed else self.file
+
+    def append(self, record: dict) -> None:
+        self.stream.write(json.dumps(record).encode('utf-8') + b'\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self, reopen: bool = True) -> None:
+        if self.compressed:
+            # Finish the current gzip member so the file is readable up to here
+            self.stream.close()
+        self.file.flush()
+        if self.fsync:
+            fsync(self.file.fileno())
+        self.count += self.pending
+        self.pending = 0
+        write_index(self.index, self.count, self.file.tell(), self.fsync)
+        if self.compressed and reopen:
+            self.stream = self.open_stream()
+
+    def close(self) -> None:
+        self.flush(reopen=False)
+        self.file.close()
+
+    def __enter__(self) -> 'RecordStore':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def open_store(name: str, compress: bool = False, flush_every: int = 1000, fsync: bool = False) -> RecordStore:
+    """ Open (or resume) today's store of results for the named experiment. """
+    filename = f'{name}-{datetime.now().strftime("%Y-%m-%d")}.jsonl' + ('.gz' if compress else '')
+    return RecordStore(filename, flush_every, fsync)
+
+def read_index(index: str) -> tuple[int, int]:
+    """ Read the (record count, file size) of a store from its sidecar index. """
+    with open(index, 'r') as f:
+        data = json.load(f)
+    return data['count'], data['offset']
+
+def write_index(index: str, count: int, offset: int, sync: bool = False) -> None:
+    # Written to a temporary file and renamed so the index is never partially written
+    with open(index + '.tmp', 'w') as f:
+        json.dump({'count': count, 'offset': offset}, f)
+        if sync:
+            f.flush()
+            fsync(f.fileno())
+    replace(index + '.tmp', index)
+
+def scan_records(filename: str) -> tuple[int, int]:
+    """ Count the complete records of a store without reading its index. Returns
+        the count and the size of the file up to the end of the last complete
+        record (of a gzip store, the last complete member), dropping any
+        partially written record left by an interrupted run. """
+    count = offset = 0
+    with open(filename, 'rb') as f:
+        if not filename.endswith('.gz'):
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                count += 1
+                offset += len(line)
+            return count, offset
+        position, lines, member = 0, 0, zlib.decompressobj(wbits=31)
+        while chunk := f.read(1 << 20):
+            while chunk:
+                try:
+                    lines += member.decompress(chunk).count(b'\n')
+                except zlib.error:
+                    return count, offset
+                if not member.eof:
+                    position += len(chunk)
+                    break
+                # Member complete: the records in it are kept
+                position += len(chunk) - len(member.unused_data)
+                count, offset, lines = count + lines, position, 0
+                chunk, member = member.unused_data, zlib.decompressobj(wbits=31)
+    return count, offset
+
+def read_lines(raw, compressed: bool) -> Iterator[bytes]:
+    """ Complete lines of a store file, ending quietly at a partially written
+        line or gzip member rather than raising as GzipFile does. """
+    if not compressed:
+        for line in raw:
+            if not line.endswith(b'\n'):
+                return
+            yield line
+        return
+    member, rest = zlib.decompressobj(wbits=31), b''
+    while chunk := raw.read(1 << 16):
+        while chunk:
+            try:
+                *lines, rest = (rest + member.decompress(chunk)).split(b'\n')
+            except zlib.error:
+                return
+            yield from (line + b'\n' for line in lines)
+            if not member.eof:
+                break
+            chunk, member = member.unused_data, zlib.decompressobj(wbits=31)
+
+def is_record_store(filename: str) -> bool:
+    return filename.endswith('.jsonl') or filename.endswith('.jsonl.gz')
+
+def read_records(filename: str, progress: bool = False) -> Iterator[dict]:
+    """ Stream the records of a store, stopping at the last flushed record.
+        If progress is set, a progress bar reports the bytes read so far. """
+    count = read_index(filename + '.idx')[0] if exists(filename + '.idx') else scan_records(filename)[0]
+    with open(filename, 'rb') as raw, tqdm(total=getsize(filename), unit='B', unit_scale=True, desc='Reading Records', disable=not progress) as pbar:
+        for i, line in enumerate(read_lines(raw, filename.endswith('.gz'))):
+            if i == count:
+                break
+            pbar.update(raw.tell() - pbar.n)
+            yield json.loads(line)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+#
+# benchmarking.py
+# February 2023
+#
+# Utilities for benchmarking the Google experiment query engine against
+# a local mock of the Programmable Search API. Should be called from the
+# command line using google.py.
+#
+from time import perf_counter
+from tqdm.auto import tqdm
+from experimenting import engines, articles, hiding_experiment, surfacing_experiment
+from mocking import MockIndex, MockSearchServer, srcf_pages
+from querying import QueryEngine
+
+def mock_server(**options) -> MockSearchServer:
+    """ Mock Programmable Search serving the SRCF deployment of the Bad Search Wiki. """
+    index = MockIndex(srcf_pages(articles, [technique for technique in engines if technique != 'all']))
+    return MockSearchServer(index, {engine: ('srcf', technique) for technique, engine in engines.items()}, **options)
+
+def experiment_searches() -> list:
+    """ The searches made by the hiding and surfacing experiments for every article. """
+    indexed = [(technique, article) for technique in engines if technique != 'all' for article in range(len(articles))]
+    return [params for experiment in (hiding_experiment, surfacing_experiment) for _, params in experiment(indexed)[2]]
+
+def benchmark(per_second=1.5, concurrency=8, retries=5, rounds=1, **options):
+    searches = experiment_searches() * rounds
+    with mock_server(port=0, **options) as server:
+        client = QueryEngine(server.google_url, params={'key': 'mock'}, per_second=per_second,
+                             concurrency=concurrency, retries=retries)
+        start = perf_counter()
+        responses = list(tqdm(client.search_all(searches), total=len(searches), desc='Benchmarking'))
+        elapsed = perf_counter() - start
+    found = sum(1 for response in responses if int(response['searchInformation']['totalResults']) > 0)
+    print(f'{len(responses)} queries in {elapsed:.2f}s ({len(responses)/elapsed:.2f} queries/sec), {found} with results.')
+    print(f'Server saw {server.stats["requests"]} requests: {server.stats["throttled"]} throttled, {server.stats["errors"]} failed.')
@@ -6,14 +6,16 @@
 # Utilities for searching experimental queries against perturbed
 # Simple Wikipedia. Should be called from the command line using elastic.py.
 #
-import pickle
-import requests
 import csv
-import time
+import heapq
+import aiohttp
+from contextlib import ExitStack
 from tqdm.auto import tqdm
-from datetime import datetime
-from os.path import exists
 from perturbations import perturb
+from querying import QueryEngine, ResponseCache, QuotaExhausted
+from records import open_store
+
+GOOGLE_URL = 'https://www.googleapis.com/customsearch/v1'
 
 # Programmable Search Engine IDs
 engines = {'all': '142159d18e7ba4f76',
@@ -29,10 +31,14 @@ engines = {'all': '142159d18e7ba4f76',
 # Articles Contained in Deployed Bad Search Wiki
 articles = ['Hans Zender', 'Great Bentley', 'Jerrier A. Haddad', 'IPhone 5C', 'Shelley, Idaho', 'A Day in the Life', 'George Polk Awards', 'Helen Herron Taft', 'Gilles Latulippe', 'Kitty Hawk, North Carolina', 'Charlotte Rae', 'Vaudes', 'Battleship Potemkin', 'Oak Park, Illinois', 'Plouégat-Guérand', 'Leah Clark', 'Free market', 'Cullowhee, North Carolina', 'Herat', 'Seaca de Câmp', 'Oro y plata', 'Jerry Mathers', 'Greg Papa', 'Duško Popov', 'Sacheen Littlefeather', 'Daydreaming (song)', 'Sverigetopplistan', 'The Godfather Part II', 'Emerson, Lake and Powell', 'Paranthropus aethiopicus', 'Didí Torrico', 'Swan', 'Christine Keeler', 'Samir Farid', 'Canonical form', 'Christina Hendricks', 'Little India MRT station', 'Tracie Spencer', 'Luc-Adolphe Tiao', 'Christopher A. Wray', 'Nezapir', 'Yoram Globus', 'Joseph D. Pistone', 'Datsakorn Thonglao', 'COVID-19 pandemic in Missouri', 'Alan Shearer', 'Shanghai World Financial Center', 'Adam Deadmarsh', '65th British Academy Film Awards', 'Members Church of God International', 'Winter solstice', 'The Family Jewels (movie)', 'Gurtnellen', 'Soriano Department', '119 Tauri', 'Adelaide Kane', 'Frances Farenthold', 'Praça Diogo de Vasconcelos', 'Centennial Olympic Park bombing', 'La Pommeraie-sur-Sèvre', 'Mycoplasma genitalium', 'Dozwil', 'Leeds Cathedral', 'Cuts Both Ways', 'Chisago Lakes', 'Aberaeron', 'Enhanced Fujita scale', 'Cappy, Somme', 'King George V DLR station', 'Claw', 'Cremona', 'Insurance (constituency)', 'Waqar Ahmad Shah', 'Ed Westcott', 'Cerebellum', '1st century BC', 'Mateur', 'Gary Staples', 'List of A2 roads', 'Naked eye', 'Odra', 'Ross Ardern', 'Twist (dance)', '2019 NASCAR Xfinity Series', 'In-N-Out Burger', 'Selous&#39; zebra', 'Hillary Clinton', 'Jussy, Aisne', 'Provinces of Oman', 'Source code', 'Vätterstads IK', 'The Illustrated World of Mortal Engines', 'First Sino-Japanese War', 'Sainte-Suzanne-et-Chammes', 'Joël Bouchard', 'Dado Cavalcanti', 'Lucky Pulpit', 'Monte Plata Province', 'Glovelier', 'Cape Breton Island']
 
-def experiment(table, key_file, experiment_name):
+def experiment(table, key_file, experiment_name, per_second=1.5, per_day=None, concurrency=8, retries=5,
+               cache=None, cache_ttl=None, replay=False, quota_file=None, endpoint=GOOGLE_URL, **store):
     with open(key_file, 'r') as f:
-        global key
-        key = f.read()
+        key = f.read().strip()
+    responses = ResponseCache(cache, cache_ttl) if cache else None
+    client = QueryEngine(endpoint, params={'key': key}, per_second=per_second, per_day=per_day,
+                         concurrency=concurrency, retries=retries, cache=responses, cache_only=replay,
+                         quota_file=quota_file if endpoint == GOOGLE_URL else None) # Mock APIs use no quota
     google_indexed = []
     with open(table) as csvfile:
         content = csv.reader(csvfile)
@@ -41,98 +47,93 @@ def experiment(table, key_file, experiment_name):
             if (len(url) == 5):
                 google_indexed.append((url[-2], int(url[-1].split('.')[0])))
     match experiment_name:
-        case 'hiding': hiding_experiment(google_indexed)
-        case 'surfacing': surfacing_experiment(google_indexed)
-        case 'all': hiding_experiment(google_indexed); surfacing_experiment(google_indexed)
+        case 'hiding': run_experiments(client, [hiding_experiment(google_indexed)], **store)
+        case 'surfacing': run_experiments(client, [surfacing_experiment(google_indexed)], **store)
+        case 'all': run_experiments(client, [hiding_experiment(google_indexed), surfacing_experiment(google_indexed)], **store)
         case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
+    if responses:
+        print(responses.stats())
+        responses.close()
 
 def hiding_experiment(google_indexed):
-    filename = f'google_serps_hiding-{datetime.now().strftime("%Y-%m-%d")}.pkl'
-    if exists(filename):
-        print('Loading previous results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = pickle.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = len(google_indexed)
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i, (technique, article) in tqdm(enumerate(google_indexed), total=count, desc='Hiding Experiment'):
-        # Skip any results already written to file
-        if i < skip:
-            continue
-
-        serp = search(engines[technique], articles[article])
-        serps.append({
-            'query': {
-                'article': article,
-                'technique': technique,
-                'title': articles[article]
-            },
-            'result': serp
-        })
-        time.sleep(0.5)
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_pickle(filename, serps)
-
-    # Write final results to file
-    write_pickle(filename, serps)
-    print(f'Hiding experiment complete. Results written to {filename}.')
+    """ Query each perturbed engine for the unperturbed titles of its articles. """
+    queries = []
+    for technique, article in google_indexed:
+        queries.append(({
+            'article': article,
+            'technique': technique,
+            'title': articles[article]
+        }, search_params(engines[technique], articles[article])))
+    return 'google_serps_hiding', 'Hiding Experiment', queries
 
 def surfacing_experiment(google_indexed):
-    filename = f'google_serps_surfacing-{datetime.now().strftime("%Y-%m-%d")}.pkl'
-    if exists(filename):
-        print('Loading previous results from file to continue experiment...')
-        with open(filename, 'rb') as f:
-            serps = pickle.load(f)['serps']
-    else:
-        serps = []
-    skip = len(serps)
-    count = len(google_indexed)
-    write_interval = count // 20 # Write every 5% of the way through
-
-    for i, (technique, article) in tqdm(enumerate(google_indexed), total=count, desc='Hiding Experiment'):
-        # Skip any results already written to file
-        if i < skip:
-            continue
-
+    """ Query the engine indexing all perturbations for the perturbed titles of each article. """
+    queries = []
+    for technique, article in google_indexed:
         perturbed = perturb(articles[article], technique)
-        serp = search(engines['all'], perturbed)
-        serps.append({
-            'query': {
-                'article': article,
-                'technique': technique,
-                'title': perturbed
-            },
-            'result': serp
-        })
-        time.sleep(0.5)
-
-        # Write results to file every 5% of the way through
-        if i % write_interval == 0:
-            write_pickle(filename, serps)
-
-    # Write final results to file
-    write_pickle(filename, serps)
-    print(f'Surfacing experiment complete. Results written to {filename}.')
-
-def search(engine: str, query: str) -> str:
+        queries.append(({
+            'article': article,
+            'technique': technique,
+            'title': perturbed
+        }, search_params(engines['all'], perturbed)))
+    return 'google_serps_surfacing', 'Surfacing Experiment', queries
+
+def run_experiments(client, experiments, **store):
+    """
+    Run the queries of several experiments concurrently through one client,
+    sharing its connection pool and rate limits. Each experiment resumes from
+    its results file, and the remaining queries are scheduled so that every
+    experiment advances at the same pace. If the query quota runs out, the
+    results gathered so far are kept and a later run carries on from there.
+    """
+    with ExitStack() as stack:
+        stores, remaining, bars = [], [], []
+        for i, (name, desc, queries) in enumerate(experiments):
+            serps = stack.enter_context(open_store(name, **store))
+            # Skip any results already written to file
+            if serps.count:
+                print(f'Continuing {desc} after {serps.count} previous results...')
+            stores.append(serps)
+            remaining.append(queries[serps.count:])
+            bars.append(stack.enter_context(tqdm(total=len(queries), initial=serps.count, desc=desc, position=i)))
+        schedule = list(prioritize([serps.count for serps in stores], remaining))
+        try:
+            for (i, query), serp in zip(schedule, client.search_all(params for _, (_, params) in schedule)):
+                stores[i].append({
+                    'query': query[0],
+                    'result': serp
+                })
+                bars[i].update()
+        except (QuotaExhausted, aiohttp.ClientResponseError) as oops:
+            if getattr(oops, 'status', 429) != 429:
+                raise
+            print('Query quota exhausted. Rerun the experiment once it has reset to continue.')
+            return
+    for (_, desc, _), serps in zip(experiments, stores):
+        print(f'{desc} complete. Results written to {serps.filename}.')
+
+def prioritize(done, remaining):
+    """ Order the remaining (record, params) queries of each experiment so
+        that the experiment with the smallest fraction of its queries done
+        always goes next. Yields (experiment, query) pairs. """
+    totals = [count + len(queries) for count, queries in zip(done, remaining)]
+    heap = [(count / total, i, 0) for i, (count, total) in enumerate(zip(done, totals)) if remaining[i]]
+    heapq.heapify(heap)
+    while heap:
+        _, i, j = heapq.heappop(heap)
+        yield i, remaining[i][j]
+        if j + 1 < len(remaining[i]):
+            heapq.heappush(heap, ((done[i] + j + 1) / totals[i], i, j + 1))
+
+def search_params(engine: str, query: str) -> dict:
+  """ Build the parameters for a query against the selected private search engine. """
+  return {'cx': engine, 'q': query}
+
+def search(client: QueryEngine, engine: str, query: str) -> dict:
   """ Run the supplied query against the selected private search engine. """
-  url =  'https://www.googleapis.com/customsearch/v1?'\
-        f'key={key}&cx={engine}&q={query}'
-  return requests.get(url).json()
+  return next(client.search_all([search_params(engine, query)]))
 
-def results(engine: str, query: str) -> int:
+def results(client: QueryEngine, engine: str, query: str) -> int:
   """ Get the number of results for the supplied query against the selected
       private search engine. """
-  return search(engine, query)['searchInformation']['totalResults']
-
-def write_pickle(filename, serps):
-    with open(filename, 'wb') as f:
-        pickle.dump({
-            'articles': articles,
-            'serps': serps
-        }, f)
\ No newline at end of file
+  return search(client, engine, query)['searchInformation']['totalResults']
@@ -7,8 +7,9 @@
 # indexing experiments using Unicode.
 #
 import argparse
-from experimenting import experiment
+from experimenting import experiment, GOOGLE_URL
 from graphing import graphs
+from benchmarking import benchmark, mock_server
 
 def main():
     # Main Parser
@@ -24,20 +25,61 @@ def main():
     # This page may be inaccessible to later users. If so, please create a new Programmable Search engine, update the IDs in experimenting.py, and export the new table after indexing.
     experiment_parser.add_argument('table', help='CSV of indexed pages exported from Google Search Console.')
     experiment_parser.add_argument('key_file', help='File containing Google API key.')
+    experiment_parser.add_argument('--per-second', help='Maximum number of queries per second.', type=float, default=1.5)
+    experiment_parser.add_argument('--per-day', help='Daily query quota. Experiments stop once it is exhausted.', type=int)
+    experiment_parser.add_argument('--quota-file', help='SQLite file counting the queries sent each day and month, so quotas hold across runs.', default='api_quota.sqlite')
+    experiment_parser.add_argument('--concurrency', help='Maximum number of queries in flight at once.', type=int, default=8)
+    experiment_parser.add_argument('--retries', help='Number of retries for rate-limited or failed queries.', type=int, default=5)
+    experiment_parser.add_argument('--cache', help='SQLite file caching API responses across runs (off by default, as results depend on the date).')
+    experiment_parser.add_argument('--cache-ttl', help='Hours after which cached responses are fetched again.', type=float)
+    experiment_parser.add_argument('--replay', help='Answer every query from the --cache file without calling the API.', action='store_true')
+    experiment_parser.add_argument('--endpoint', help='URL of the Programmable Search API, e.g. a local mock server.', default=GOOGLE_URL)
+    experiment_parser.add_argument('--compress', help='Gzip-compress the results files.', action='store_true')
+    experiment_parser.add_argument('--flush-every', help='Number of results written between flushes of the results files.', type=int, default=1000)
+    experiment_parser.add_argument('--fsync', help='Sync the results files to disk on every flush.', action='store_true')
 
     # Graphs Parser
     graphs_parser = subparsers.add_parser('graphs', help='Build Graphs for Experimental Results', description='Build Graphs for Experimental Results')
     graphs_parser.add_argument('experiment_name', help='Experimental Graphs to Build. Either "hiding", "surfacing", or "all".')
-    graphs_parser.add_argument('pickle_file', help='Pickle file of experimental results for building graphs.')
+    graphs_parser.add_argument('pickle_file', help='Pickle or JSONL file of experimental results for building graphs.')
     
+    # Mock Server Parser
+    mock_parser = subparsers.add_parser('mock', help='Serve a Local Mock of the Programmable Search API', description='Serve a Local Mock of the Programmable Search API')
+    mock_options(mock_parser)
+    mock_parser.add_argument('--port', help='Port to serve the mock API on.', type=int, default=8080)
+
+    # Benchmark Parser
+    benchmark_parser = subparsers.add_parser('benchmark', help='Benchmark Experiment Queries against a Local Mock API', description='Benchmark Experiment Queries against a Local Mock API')
+    mock_options(benchmark_parser)
+    benchmark_parser.add_argument('--per-second', help='Maximum number of queries per second sent by the client.', type=float, default=1.5)
+    benchmark_parser.add_argument('--concurrency', help='Maximum number of queries in flight at once.', type=int, default=8)
+    benchmark_parser.add_argument('--retries', help='Number of retries for rate-limited or failed queries.', type=int, default=5)
+    benchmark_parser.add_argument('--rounds', help='Number of times to run the experiment queries.', type=int, default=1)
+
     # Parse arguments
     args = parser.parse_args()
+    if args.command == 'experiment' and args.replay and not args.cache:
+        parser.error('--replay requires --cache')
 
     # Invoke function to handle verb
     match args.command:
-        case 'experiment': experiment(args.table, args.key_file, args.experiment_name)
+        case 'experiment': experiment(args.table, args.key_file, args.experiment_name, args.per_second, args.per_day,
+                                      args.concurrency, args.retries, args.cache,
+                                      args.cache_ttl and args.cache_ttl * 3600, args.replay, args.quota_file,
+                                      endpoint=args.endpoint, compress=args.compress, flush_every=args.flush_every, fsync=args.fsync)
+        case 'mock': mock_server(port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                 throttle_rate=args.throttle_rate, server_per_second=args.server_per_second).serve()
+        case 'benchmark': benchmark(args.per_second, args.concurrency, args.retries, args.rounds, latency=args.latency, jitter=args.jitter,
+                                    error_rate=args.error_rate, throttle_rate=args.throttle_rate, server_per_second=args.server_per_second)
         case 'graphs': graphs(args.experiment_name, args.pickle_file)
         case _ : raise ValueError(f'Unknown verb: {args.command}')
 
+def mock_options(parser):
+    parser.add_argument('--latency', help='Seconds taken by the mock API to answer each query.', type=float, default=0.1)
+    parser.add_argument('--jitter', help='Maximum random seconds added to the latency.', type=float, default=0.05)
+    parser.add_argument('--error-rate', help='Fraction of queries failing with a 503.', type=float, default=0)
+    parser.add_argument('--throttle-rate', help='Fraction of queries rejected with a 429.', type=float, default=0)
+    parser.add_argument('--server-per-second', help='Queries per second accepted by the mock API before it returns 429s.', type=float)
+
 if __name__ == '__main__':
     main()
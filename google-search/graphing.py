@@ -10,6 +10,7 @@ import pickle
 import matplotlib.pyplot as plt
 from collections import Counter
 from perturbations import perturbations
+from records import is_record_store, read_records
 
 def graphs(experiment_name, pickle_file):
     match experiment_name:
@@ -19,9 +20,8 @@ def graphs(experiment_name, pickle_file):
         case _ : raise ValueError(f'Unknown experiment: {experiment_name}')
 
 def hiding_graphs(pickle_file):
-    # Load the pickle file
-    with open(pickle_file, 'rb') as f:
-        serps = pickle.load(f)['serps']
+    # Load the results file
+    serps = load_serps(pickle_file)
 
     performance = {}
     for technique in ['base', 'zwsp', 'zwnj', 'zwj', 'rlo', 'bksp', 'del', 'homo']:
@@ -66,9 +66,8 @@ def hiding_graphs(pickle_file):
     print('Hiding bar chart saved to google_hiding.[svg/png/pdf].')
 
 def surfacing_graphs(pickle_file):
-    # Load the pickle file
-    with open(pickle_file, 'rb') as f:
-        serps = pickle.load(f)['serps']
+    # Load the results file
+    serps = load_serps(pickle_file)
 
     count = Counter()
     for serp in serps:
@@ -101,4 +100,12 @@ def surfacing_graphs(pickle_file):
     plt.savefig('google_surfacing.svg', bbox_inches='tight')
     plt.savefig('google_surfacing.png', bbox_inches='tight')
     plt.savefig('google_surfacing.pdf', bbox_inches='tight')
-    print('Surfacing pie charts saved to google_surfacing.[svg/png/pdf].')
\ No newline at end of file
+    print('Surfacing pie charts saved to google_surfacing.[svg/png/pdf].')
+
+def load_serps(pickle_file):
+    """ Yield the SERPs stored in a pickle or JSONL file of experimental results. """
+    if is_record_store(pickle_file):
+        yield from read_records(pickle_file)
+    else:
+        with open(pickle_file, 'rb') as f:
+            yield from pickle.load(f)['serps']
\ No newline at end of file
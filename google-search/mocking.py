@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# mocking.py
+# February 2023
+#
+# Local stand-in for the Bing Custom Search and Google Programmable
+# Search APIs, serving the Bad Search Wiki articles so that the
+# experiment drivers can be tested and benchmarked offline.
+#
+import asyncio
+import random
+import time
+from threading import Thread
+from collections import Counter, defaultdict, deque
+from typing import Iterable, Iterator
+from urllib.parse import quote, unquote
+from aiohttp import web
+from perturbations import perturb
+
+SRCF_SITE = 'https://badsearch.soc.srcf.net'
+ML_SITE = 'badsearch.ml'
+BING_PATH = '/v7.0/custom/search'
+GOOGLE_PATH = '/customsearch/v1'
+
+def srcf_pages(articles: list, techniques: Iterable[str]) -> Iterator[tuple]:
+    """ Pages of the static SRCF deployment, served as /{technique}/{index}.html """
+    for technique in techniques:
+        for index, title in enumerate(articles):
+            yield 'srcf', technique, f'{SRCF_SITE}/{technique}/{index}.html', perturb(title, technique)
+
+def ml_pages(titles: Iterable[str], techniques: Iterable[str]) -> Iterator[tuple]:
+    """ Pages of the dynamic ML deployment, served as {technique}.badsearch.ml/article/{title} """
+    for technique in techniques:
+        for title in titles:
+            perturbed = perturb(title, technique)
+            yield 'ml', technique, f'https://{technique}.{ML_SITE}/article/{quote(perturbed)}', perturbed
+
+class MockIndex():
+    """
+    Index of (site, technique, url, title) pages by the words of their
+    titles. Pages are ranked by the number of query words in their title.
+    """
+    def __init__(self, pages: Iterable[tuple]):
+        self.pages = list(pages)
+        self.postings = defaultdict(list)
+        for i, (_, _, _, title) in enumerate(self.pages):
+            for word in set(title.lower().split()):
+                self.postings[word].append(i)
+
+    def search(self, query: str, site: str, technique: str, count: int = 10) -> list:
+        scores = Counter()
+        for word in set(query.lower().split()):
+            for i in self.postings.get(word, ()):
+                page_site, page_technique, _, _ = self.pages[i]
+                if page_site == site and technique in ('all', page_technique):
+                    scores[i] += 1
+        return [self.pages[i] for i, _ in scores.most_common(count)]
+
+class MockSearchServer():
+    """
+    Local HTTP server answering Bing Custom Search and Google Programmable
+    Search requests from a MockIndex, where `engines` maps each engine ID to
+    the (site, technique) it searches. Every response is delayed by `latency`
+    seconds plus up to `jitter`, a fraction `error_rate` of requests fail with
+    a 503 and a fraction `throttle_rate` are rejected with a 429, as are all
+    requests beyond `server_per_second` in any one second. Used as a context
+    manager, the server runs in a background thread.
+    """
+    def __init__(self, index: MockIndex, engines: dict, host: str = '127.0.0.1', port: int = 8080, latency: float = 0.1,
+                 jitter: float = 0.05, error_rate: float = 0, throttle_rate: float = 0, server_per_second: float = None):
+        self.index = index
+        self.engines = engines
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.server_per_second = server_per_second
+        self.recent = deque()
+        self.stats = Counter()
+        self.app = web.Application()
+        self.app.router.add_get(BING_PATH, self.bing)
+        self.app.router.add_get(GOOGLE_PATH, self.google)
+
+    @property
+    def bing_url(self) -> str:
+        return f'http://{self.host}:{self.port}{BING_PATH}'
+
+    @property
+    def google_url(self) -> str:
+        return f'http://{self.host}:{self.port}{GOOGLE_PATH}'
+
+    async def respond(self, engine: str, query: str):
+        """ Apply the injected latency and failures, then run the search. """
+        self.stats['requests'] += 1
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] >= 1:
+            self.recent.popleft()
+        if (self.server_per_second and len(self.recent) >= self.server_per_second) or random.random() < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.json_response({'error': {'code': 429, 'message': 'Rate limit exceeded'}}, status=429, headers={'Retry-After': '1'})
+        self.recent.append(now)
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.json_response({'error': {'code': 503, 'message': 'Service unavailable'}}, status=503)
+        if engine not in self.engines or query is None:
+            self.stats['errors'] += 1
+            return web.json_response({'error': {'code': 400, 'message': 'Invalid engine or query'}}, status=400)
+        return self.index.search(query, *self.engines[engine])
+
+    async def bing(self, request: web.Request) -> web.Response:
+        query = request.query.get('q')
+        hits = await self.respond(request.query.get('customconfig'), query)
+        if isinstance(hits, web.Response):
+            return hits
+        response = {'_type': 'SearchResponse', 'queryContext': {'originalQuery': query}}
+        if hits: # Bing omits webPages when nothing matches
+            response['webPages'] = {
+                'webSearchUrl': f'https://www.bing.com/search?q={quote(query)}',
+                'totalEstimatedMatches': len(hits),
+                'value': [{
+                    'id': f'https://api.bing.microsoft.com/api/v7/#WebPages.{i}',
+                    'name': 'Bad Search Wiki',
+                    'url': url,
+                    'displayUrl': unquote(url),
+                    'snippet': title
+                } for i, (_, _, url, title) in enumerate(hits)]
+            }
+        return web.json_response(response)
+
+    async def google(self, request: web.Request) -> web.Response:
+        query, engine = request.query.get('q'), request.query.get('cx')
+        hits = await self.respond(engine, query)
+        if isinstance(hits, web.Response):
+            return hits
+        response = {
+            'kind': 'customsearch#search',
+            'queries': {'request': [{'searchTerms': query, 'cx': engine, 'totalResults': str(len(hits)), 'count': len(hits), 'startIndex': 1}]},
+            'searchInformation': {'searchTime': self.latency, 'totalResults': str(len(hits)), 'formattedTotalResults': str(len(hits))}
+        }
+        if hits: # Google omits items when nothing matches
+            response['items'] = [{
+                'kind': 'customsearch#result',
+                'title': 'Bad Search Wiki - SRCF',
+                'link': url,
+                'displayLink': url.split('/')[2],
+                'snippet': title
+            } for _, _, url, title in hits]
+        return web.json_response(response)
+
+    def serve(self) -> None:
+        """ Serve requests until interrupted. """
+        web.run_app(self.app, host=self.host, port=self.port)
+
+    def __enter__(self) -> 'MockSearchServer':
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(self.app)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, self.host, self.port).start())
+        self.port = self.runner.addresses[0][1] # Resolves port 0 to the port picked by the OS
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
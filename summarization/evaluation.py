@@ -0,0 +1,64 @@
+import time
+import torch
+
+
+###----batched evaluation of a population -----------------
+class population_evaluator():
+    def __init__(self, summarizer, batch_size = 8, max_length = None):
+        """
+            summarizer: the HF summarization pipeline, whose model and tokenizer are used directly.
+            batch_size: number of candidates forwarded together.
+            max_length: candidates are truncated to this many tokens (default: the model maximum).
+        """
+        self.model = summarizer.model
+        self.tokenizer = summarizer.tokenizer
+        self.device = summarizer.device
+        self.batch_size = batch_size
+        self.max_length = max_length or self.tokenizer.model_max_length
+        self.cache = {}
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def reset(self):
+        """ Forget the summaries of the previous sentence"""
+        self.cache = {}
+
+    @property
+    def tokens_per_second(self):
+        """ Throughput of the last call to summarize, counting input and generated tokens"""
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+    def summarize(self, batch):
+        """
+            Given a list of sentences [batch], it returns a list of summarizations.
+            Each distinct sentence is forwarded once: the BART encoder is bidirectional, so
+            candidates sharing only a prefix share no encoder states, but duplicated candidates
+            (and candidates already seen in previous iterations) share the whole output.
+        """
+        pending = [x for x in dict.fromkeys(batch) if x not in self.cache]
+        self.tokens, self.seconds = 0, 0.0
+
+        if pending:
+            start = time.perf_counter()
+
+            #tokenize once, then sort by length so that each batch needs little padding
+            input_ids = self.tokenizer(pending, truncation=True, max_length=self.max_length)['input_ids']
+            order = sorted(range(len(pending)), key=lambda i: len(input_ids[i]))
+
+            for b in range(0, len(order), self.batch_size):
+                idx = order[b:b + self.batch_size]
+                inputs = self.tokenizer.pad({'input_ids': [input_ids[i] for i in idx]}, return_tensors='pt').to(self.device)
+
+                #forward the model -- same decoding as the pipeline
+                with torch.no_grad():
+                    output = self.model.generate(**inputs, do_sample=False)
+
+                summaries = self.tokenizer.batch_decode(output, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+                for i, summary in zip(idx, summaries):
+                    self.cache[pending[i]] = summary
+
+                self.tokens += int(inputs['attention_mask'].sum()) + int((output != self.tokenizer.pad_token_id).sum())
+
+            self.seconds = time.perf_counter() - start
+
+        return [self.cache[x] for x in batch]
@@ -9,6 +9,7 @@ from transformers import pipeline
 from transformers import AutoTokenizer, AutoModel
 import torch
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from evaluation import population_evaluator
 import json
 import datetime
 from datasets import load_dataset
@@ -59,12 +60,16 @@ def load_vocabulary():
 
 ###----define the adversarial class -----------------
 class adversarial_summarizer():
-    def __init__(self, model):
+    def __init__(self, model, batch_size = 8, max_length = None):
         """
             model: the summarizer istance.
+            batch_size: number of candidates summarized together.
+            max_length: candidates are truncated to this many tokens (default: the model maximum).
         """
         #save the settings
         self.model = model
+        self.evaluator = population_evaluator(model, batch_size = batch_size, max_length = max_length)
+        self.smoothing = SmoothingFunction().method1
         self.alphabet = string.ascii_letters
         self.log_c2h = load_vocabulary()
         self.log_h2c = {}
@@ -83,13 +88,8 @@ class adversarial_summarizer():
         """
             Given a list of sentences [batch], it returns a list of summatizations.
         """
-        #forward the model
-        x = self.model(batch, truncation=True, do_sample=False)
-
-        #unpack the results
-        x = [xx['summary_text'] for xx in x]
-
-        return x
+        #forward the model in padded batches sorted by length
+        return self.evaluator.summarize(batch)
 
     def score_function(self, y_true_summ, batch_cand):
         #empty vector containing the results
@@ -99,9 +99,10 @@ class adversarial_summarizer():
         # that might affect the scoring function
         batch_cand = [self.sanitize(x) for x in batch_cand]
 
+        reference = [y_true_summ.split()]
         for cand in batch_cand:
             # print(y_true_summ, "\n" ,cand, "\n\n\n")
-            score = sentence_bleu([y_true_summ.split()], cand.split(), smoothing_function=SmoothingFunction().method1)
+            score = sentence_bleu(reference, cand.split(), smoothing_function=self.smoothing)
             res.append(score)
 
         return res
@@ -162,6 +163,7 @@ class adversarial_summarizer():
 
     def adversarial_generation(self, sentence, max_population = 20, step = 250, max_it = -1, min_score = .05):
         """ Main routine to generate the adversarial samples """
+        self.evaluator.reset()
         #the following duplicated lines are essential to allow sentence == sanitize(x_adv)
         sentence = ' '.join(word_tokenize(sentence))
         sentence = ' '.join(word_tokenize(sentence))
@@ -231,7 +233,7 @@ class adversarial_summarizer():
             population_best_cand = population_log[0]
 
             # print(f"\nIteration {it + 1} executed in:\t{end - start}")
-            print(f"\t--->best candidate score: {population_best_cand[2]:.4f}")
+            print(f"\t--->best candidate score: {population_best_cand[2]:.4f}\t Tokens/sec: {self.evaluator.tokens_per_second:.1f}")
 
             #check if we can improve or if we reached a local / global minimum
             if population_best_cand[2] <= min_score: #improvement